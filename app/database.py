@@ -4,16 +4,85 @@ SQLite database for report caching and IP quota management.
 import sqlite3
 import datetime
 import os
+import queue
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock_research.db")
 DAILY_FREE_QUOTA = 3
 DAILY_GLOBAL_LIMIT = 200  # 根據預算（約 100 元台幣/月）推算，全站每日新報告上限為 200 份
+POOL_SIZE = 8
+
+REPORT_MEM_CACHE_SIZE = 256
+STATEMENT_CACHE_SIZE = 64
+
+# Hot-path SQL kept as constants so each pooled connection's statement cache
+# reuses the compiled plan instead of re-parsing on every call
+SQL_SELECT_CACHED_REPORT = (
+    "SELECT content, date FROM report_cache WHERE ticker = ? AND date IN (?, ?, ?) "
+    "ORDER BY date DESC LIMIT 1"
+)
+# Insert and overwrite are separate statements so save_report can tell a new row
+# (which counts toward the global limit) from a same-day overwrite
+SQL_INSERT_REPORT = (
+    "INSERT INTO report_cache (ticker, date, content) VALUES (?, ?, ?) "
+    "ON CONFLICT(ticker, date) DO NOTHING"
+)
+SQL_UPDATE_REPORT = (
+    "UPDATE report_cache SET content = ?, created_at = CURRENT_TIMESTAMP WHERE ticker = ? AND date = ?"
+)
+SQL_GET_QUOTA = "SELECT used_count FROM ip_quota WHERE ip_address = ? AND date = ?"
+SQL_INCREMENT_QUOTA = (
+    "INSERT INTO ip_quota (ip_address, date, used_count) VALUES (?, ?, 1) "
+    "ON CONFLICT(ip_address, date) DO UPDATE SET used_count = used_count + 1"
+)
+SQL_REFUND_QUOTA = (
+    "UPDATE ip_quota SET used_count = used_count - 1 "
+    "WHERE ip_address = ? AND date = ? AND used_count > 0"
+)
+SQL_COUNT_REPORTS = "SELECT COUNT(*) as count FROM report_cache WHERE date = ?"
+SQL_COUNT_USERS = "SELECT COUNT(DISTINCT ip_address) as count FROM ip_quota WHERE date = ?"
+
+# Long-lived connections shared by all helpers (filled by init_db)
+_pool = queue.Queue(maxsize=POOL_SIZE)
+
+# Hot-ticker cache in front of report_cache, keyed by (ticker, today)
+_report_mem_cache: "OrderedDict[tuple[str, str], dict]" = OrderedDict()
+_report_mem_lock = threading.Lock()
+
+# Reports generated today, so the global limit check skips COUNT(*) after the
+# first request of the day. Per-process: it only sees this process's inserts and
+# is rehydrated from SQLite on date change, so with several workers each one
+# undercounts the others' reports until the next day.
+_global_counter = {"date": None, "count": 0}
+_global_counter_lock = threading.Lock()
+
+UTC8_OFFSET = 8 * 3600
+# (day index since epoch in UTC+8, "YYYY-MM-DD") for get_today_str
+_today_cache = (None, "")
 
 
 def get_db():
-    """Get a database connection with row factory."""
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Get a database connection with row factory and tuned pragmas.
+    Connections run in autocommit mode; multi-statement work opens its own
+    transaction explicitly (see reserve_slot).
+    """
+    conn = sqlite3.connect(
+        DB_PATH,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
     conn.row_factory = sqlite3.Row
+    # Per-connection settings (journal_mode=WAL is persisted by init_db)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # ~64 MiB page cache
+    conn.execute("PRAGMA foreign_keys=ON")
     return conn
 
 
@@ -22,6 +91,11 @@ def init_db():
     conn = get_db()
     cursor = conn.cursor()
 
+    # WAL lets readers proceed while a writer commits; the mode is stored in the DB file
+    mode = cursor.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if mode.lower() != "wal":
+        print(f"[Warning] SQLite WAL 模式未啟用，目前為 {mode}")
+
     # Report cache table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS report_cache (
@@ -45,45 +119,105 @@ def init_db():
         )
     """)
 
+    # The UNIQUE indexes lead with ticker/ip_address, so per-day counts need their own
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_date ON report_cache(date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quota_date ON ip_quota(date)")
+
     conn.commit()
+
+    # Refresh planner statistics so the new indexes get picked up
+    cursor.execute("ANALYZE")
     conn.close()
 
+    # Pre-open pooled connections now that the schema and WAL mode are in place
+    while not _pool.full():
+        _pool.put_nowait(get_db())
+
+
+@contextmanager
+def borrow():
+    """
+    Borrow a pooled connection for the duration of a with-block.
+    Falls back to a fresh connection if the pool is empty, and rolls back
+    any open transaction on error so the connection goes back clean.
+    """
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = get_db()
+    try:
+        yield conn
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
 
 def get_today_str():
-    """Get today's date string in YYYY-MM-DD format (UTC+8)."""
-    return (datetime.datetime.utcnow() + datetime.timedelta(hours=8)).strftime("%Y-%m-%d")
+    """Get today's date string in YYYY-MM-DD format (UTC+8), formatted once per day."""
+    global _today_cache
+    now = time.time() + UTC8_OFFSET
+    bucket = int(now // 86400)
+    cached_bucket, cached_str = _today_cache
+    if bucket != cached_bucket:
+        cached_str = time.strftime("%Y-%m-%d", time.gmtime(now))
+        _today_cache = (bucket, cached_str)
+    return cached_str
 
 
 # === Report Cache ===
 
-def get_cached_report(ticker: str) -> dict | None:
-    """
-    Get cached report for a ticker from the last 3 days.
-    Returns {"content": str, "cached": True, "date": str} or None.
-    """
-    conn = get_db()
-    cursor = conn.cursor()
-    
+def _select_cached_report(conn, ticker: str) -> dict | None:
+    """Look up the newest cached report for a ticker from the last 3 days."""
     base_time = datetime.datetime.utcnow() + datetime.timedelta(hours=8)
     dates = [(base_time - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(3)]
     
-    placeholders = ",".join("?" for _ in dates)
-    query = f"SELECT content, date FROM report_cache WHERE ticker = ? AND date IN ({placeholders}) ORDER BY date DESC LIMIT 1"
-    
     params = [ticker.upper()] + dates
-    cursor.execute(query, params)
-    row = cursor.fetchone()
-    conn.close()
+    row = conn.execute(SQL_SELECT_CACHED_REPORT, params).fetchone()
 
     if row:
         return {"content": row["content"], "cached": True, "date": row["date"]}
     return None
 
+
+def _mem_cache_get(key: tuple[str, str]) -> dict | None:
+    with _report_mem_lock:
+        # Drop entries left over from previous days
+        stale = [k for k in _report_mem_cache if k[1] != key[1]]
+        for k in stale:
+            del _report_mem_cache[k]
+        report = _report_mem_cache.get(key)
+        if report is not None:
+            _report_mem_cache.move_to_end(key)
+        return report
+
+
+def _mem_cache_put(key: tuple[str, str], report: dict):
+    with _report_mem_lock:
+        _report_mem_cache[key] = report
+        _report_mem_cache.move_to_end(key)
+        while len(_report_mem_cache) > REPORT_MEM_CACHE_SIZE:
+            _report_mem_cache.popitem(last=False)
+
+
+def _lookup_cached_report(conn, ticker: str) -> dict | None:
+    """Serve hot tickers from memory, falling back to SQLite on a miss."""
+    key = (ticker.upper(), get_today_str())
+    report = _mem_cache_get(key)
+    if report is None:
+        report = _select_cached_report(conn, ticker)
+        if report is not None:
+            _mem_cache_put(key, report)
+    return report
+
+
 def get_recent_reports(days: int = 3, limit: int = 12) -> list:
     """Get a list of recently searched tickers in the last few days."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
     base_time = datetime.datetime.utcnow() + datetime.timedelta(hours=8)
     dates = [(base_time - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
     
@@ -91,105 +225,117 @@ def get_recent_reports(days: int = 3, limit: int = 12) -> list:
     query = f"SELECT ticker, MAX(date) as recent_date FROM report_cache WHERE date IN ({placeholders}) GROUP BY ticker ORDER BY recent_date DESC LIMIT ?"
     
     params = dates + [limit]
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+    with borrow() as conn:
+        rows = conn.execute(query, params).fetchall()
     
     return [{"ticker": row["ticker"], "date": row["recent_date"]} for row in rows]
 
 
 def save_report(ticker: str, content: str):
     """Save a report to cache."""
-    conn = get_db()
-    cursor = conn.cursor()
     today = get_today_str()
 
-    cursor.execute(
-        "INSERT OR REPLACE INTO report_cache (ticker, date, content) VALUES (?, ?, ?)",
-        (ticker.upper(), today, content)
-    )
-    conn.commit()
-    conn.close()
+    with borrow() as conn:
+        inserted = conn.execute(SQL_INSERT_REPORT, (ticker.upper(), today, content)).rowcount == 1
+        if not inserted:
+            conn.execute(SQL_UPDATE_REPORT, (content, ticker.upper(), today))
+
+    if inserted:
+        with _global_counter_lock:
+            # Only new rows: COUNT(*) over report_cache, which this mirrors, ignores overwrites
+            if _global_counter["date"] == today:
+                _global_counter["count"] += 1
+
+    _mem_cache_put((ticker.upper(), today), {"content": content, "cached": True, "date": today})
 
 
 # === IP Quota ===
 
+def _select_used_count(conn, ip: str, today: str) -> int:
+    """Number of quota units an IP has used on the given date."""
+    row = conn.execute(SQL_GET_QUOTA, (ip, today)).fetchone()
+    return row["used_count"] if row else 0
+
+
+def _increment_quota(conn, ip: str, today: str):
+    conn.execute(SQL_INCREMENT_QUOTA, (ip, today))
+
+
+def _count_reports(conn, today: str) -> int:
+    return conn.execute(SQL_COUNT_REPORTS, (today,)).fetchone()["count"]
+
+
+def _global_usage(conn, today: str) -> int:
+    """Today's report count from memory, refreshed from SQLite when the date rolls over."""
+    with _global_counter_lock:
+        if _global_counter["date"] != today:
+            _global_counter["count"] = _count_reports(conn, today)
+            _global_counter["date"] = today
+        return _global_counter["count"]
+
+
 def get_remaining_quota(ip: str) -> int:
     """Get remaining free queries for an IP today."""
-    conn = get_db()
-    cursor = conn.cursor()
     today = get_today_str()
 
-    cursor.execute(
-        "SELECT used_count FROM ip_quota WHERE ip_address = ? AND date = ?",
-        (ip, today)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with borrow() as conn:
+        used = _select_used_count(conn, ip, today)
 
-    used = row["used_count"] if row else 0
     return max(0, DAILY_FREE_QUOTA - used)
 
 
-def use_quota(ip: str) -> bool:
-    """
-    Use one query quota for an IP.
-    Returns True if quota was available, False if exceeded.
-    """
-    conn = get_db()
-    cursor = conn.cursor()
-    today = get_today_str()
-
-    # Check current usage
-    cursor.execute(
-        "SELECT used_count FROM ip_quota WHERE ip_address = ? AND date = ?",
-        (ip, today)
-    )
-    row = cursor.fetchone()
-    used = row["used_count"] if row else 0
-
-    if used >= DAILY_FREE_QUOTA:
-        conn.close()
-        return False
-
-    # Increment
-    cursor.execute(
-        "INSERT INTO ip_quota (ip_address, date, used_count) VALUES (?, ?, 1) "
-        "ON CONFLICT(ip_address, date) DO UPDATE SET used_count = used_count + 1",
-        (ip, today)
-    )
-    conn.commit()
-    conn.close()
-    return True
+def refund_quota(ip: str):
+    """Give back a quota unit taken by reserve_slot when no report was delivered."""
+    with borrow() as conn:
+        conn.execute(SQL_REFUND_QUOTA, (ip, get_today_str()))
 
 
 def get_global_usage_today() -> int:
     """Get the number of new reports generated today (globally)."""
-    conn = get_db()
-    cursor = conn.cursor()
     today = get_today_str()
-    cursor.execute("SELECT COUNT(*) as count FROM report_cache WHERE date = ?", (today,))
-    count = cursor.fetchone()["count"]
-    conn.close()
-    return count
+    with borrow() as conn:
+        return _global_usage(conn, today)
 
 
-def check_global_limit() -> bool:
-    """Check if global daily limit has been reached. Returns True if OK to proceed."""
-    return get_global_usage_today() < DAILY_GLOBAL_LIMIT
+def reserve_slot(conn, ip: str, ticker: str) -> tuple[dict | None, int, bool]:
+    """
+    Cache lookup, quota check, global-limit check and quota use in one
+    BEGIN IMMEDIATE transaction, so concurrent requests cannot both pass
+    the quota check before either increments it.
+
+    Returns (cached, remaining, global_ok):
+    - cached: the cached report dict, or None. When set, nothing is charged.
+    - remaining: the IP's remaining quota *before* this request.
+    - global_ok: whether the global daily limit still has room (only
+      checked when the IP still has quota; True otherwise).
+    A quota unit is consumed only when cached is None, remaining > 0 and
+    global_ok are all true.
+    """
+    today = get_today_str()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cached = _lookup_cached_report(conn, ticker)
+        remaining = max(0, DAILY_FREE_QUOTA - _select_used_count(conn, ip, today))
+        global_ok = True
+        if not cached and remaining > 0:
+            global_ok = _global_usage(conn, today) < DAILY_GLOBAL_LIMIT
+            if global_ok:
+                _increment_quota(conn, ip, today)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return cached, remaining, global_ok
 
 
 def get_cache_stats() -> dict:
     """Get cache statistics for today."""
-    conn = get_db()
-    cursor = conn.cursor()
     today = get_today_str()
 
-    cursor.execute("SELECT COUNT(*) as count FROM report_cache WHERE date = ?", (today,))
-    cached = cursor.fetchone()["count"]
+    with borrow() as conn:
+        cached = _count_reports(conn, today)
+        users = conn.execute(SQL_COUNT_USERS, (today,)).fetchone()["count"]
 
-    cursor.execute("SELECT COUNT(DISTINCT ip_address) as count FROM ip_quota WHERE date = ?", (today,))
-    users = cursor.fetchone()["count"]
-
-    conn.close()
     return {"cached_reports_today": cached, "unique_users_today": users}
@@ -2,13 +2,17 @@
 AI 個股研究員 MVP — FastAPI Backend
 """
 import os
+import re
 import sys
+import asyncio
 import datetime
+import functools
+import contextlib
 import concurrent.futures
 
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel
 
 # Add parent directory to path so we can import modules
@@ -19,92 +23,105 @@ load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file_
 
 from modules.data_fetcher import DataFetcher
 from modules.analyzer import MarketAnalyzer
-from app.database import init_db, get_cached_report, save_report, get_remaining_quota, use_quota, get_cache_stats, check_global_limit, get_global_usage_today, get_recent_reports
+from app.stock_names import STOCK_NAMES
+from app.database import init_db, borrow, reserve_slot, refund_quota, save_report, get_remaining_quota, get_cache_stats, get_global_usage_today, get_recent_reports
 
 # === Config ===
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+LLM_MAX_WORKERS = 4
+LLM_TIMEOUT_SECONDS = 120
+# Retry backoff budget per generation; well below LLM_TIMEOUT_SECONDS so the
+# last attempt still has time to run before the request times out
+LLM_MAX_RETRY_WAIT = 60
 
 # === Init ===
-app = FastAPI(title="AI 個股研究員", version="1.0.0")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Gemini calls block for the whole generation; run them on a small dedicated
+    # pool so the event loop keeps serving quota/cached requests meanwhile
+    app.state.llm_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS)
+    try:
+        yield
+    finally:
+        app.state.llm_pool.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="AI 個股研究員", version="1.0.0", lifespan=lifespan)
 init_db()
 
 # Serve static files
 static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+_INDEX_PATH = os.path.join(static_dir, "index.html")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 
+# === Ticker validation ===
+_HAN_RE = re.compile(r"[\u4e00-\u9fff]")
+# Taiwan codes (2330) and Yahoo-style symbols (TSM, BRK-B, 2330.TW, ^GSPC)
+_TICKER_RE = re.compile(r"[A-Z0-9.^=-]{2,16}")
+
+
 # === Models ===
 class ResearchRequest(BaseModel):
     ticker: str
 
 
-# === Stock name mapping (common Taiwan stocks) ===
-STOCK_NAMES = {
-    "1301": "台塑", "1303": "南亞", "2002": "中鋼", "2207": "和泰車",
-    "2301": "光寶科", "2303": "聯電", "2308": "台達電", "2312": "金寶",
-    "2317": "鴻海", "2327": "國巨", "2330": "台積電", "2337": "旺宏",
-    "2345": "智邦", "2353": "宏碁", "2354": "鴻準", "2356": "英業達",
-    "2357": "華碩", "2376": "技嘉", "2377": "微星", "2379": "瑞昱",
-    "2382": "廣達", "2395": "研華", "2409": "友達", "2412": "中華電",
-    "2454": "聯發科", "2474": "可成", "2492": "華新科", "2498": "宏達電",
-    "2603": "長榮", "2609": "陽明", "2615": "萬海", "2880": "華南金",
-    "2881": "富邦金", "2882": "國泰金", "2883": "凱基金", "2884": "玉山金",
-    "2885": "元大金", "2886": "兆豐金", "2887": "台新金", "2890": "永豐金",
-    "2891": "中信金", "2892": "第一金", "3008": "大立光", "3034": "聯詠",
-    "3037": "欣興", "3105": "穩懋", "3189": "景碩", "3231": "緯創",
-    "3260": "威剛", "3293": "鈊象", "3443": "創意", "3481": "群創",
-    "3661": "世芯KY", "3711": "日月光", "4904": "遠傳", "4938": "和碩",
-    "5347": "世界", "5871": "中租KY", "6239": "力成", "6415": "矽力KY",
-    "6505": "台塑化", "6669": "緯穎", "8046": "南電", "8454": "富邦媒",
-}
+@functools.lru_cache(maxsize=1)
+def get_fetcher() -> DataFetcher:
+    """Process-wide DataFetcher, built on first use and reused across requests."""
+    return DataFetcher(TAVILY_API_KEY)
+
+
+@functools.lru_cache(maxsize=1)
+def get_analyzer() -> MarketAnalyzer:
+    """Process-wide MarketAnalyzer, built on first use and reused across requests."""
+    return MarketAnalyzer(GEMINI_API_KEY)
 
 
 def get_client_ip(request: Request) -> str:
     """Extract client IP from request."""
     forwarded = request.headers.get("X-Forwarded-For")
     if forwarded:
-        return forwarded.split(",")[0].strip()
+        return forwarded.partition(",")[0].strip()
     return request.client.host
 
 
-def generate_stock_research(ticker: str) -> str:
+async def generate_stock_research(ticker: str) -> str:
     """
     Generate a deep research report for a single stock.
     Reuses existing data_fetcher and analyzer modules.
     """
     stock_name = STOCK_NAMES.get(ticker, ticker)
 
-    fetcher = DataFetcher(TAVILY_API_KEY)
-    analyzer = MarketAnalyzer(GEMINI_API_KEY)
+    fetcher = get_fetcher()
+    analyzer = get_analyzer()
 
-    # Use ThreadPoolExecutor to run blocking network calls concurrently
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        # 1. Start fetching stock data
-        def fetch_stock(ticker_symbol):
-            if ticker_symbol.isdigit():
-                symbol = f"{ticker_symbol}.TW"
+    def fetch_stock(ticker_symbol):
+        if ticker_symbol.isdigit():
+            symbol = f"{ticker_symbol}.TW"
+            data = fetcher.get_stock_data(symbol)
+            if not data:
+                symbol = f"{ticker_symbol}.TWO"
                 data = fetcher.get_stock_data(symbol)
-                if not data:
-                    symbol = f"{ticker_symbol}.TWO"
-                    data = fetcher.get_stock_data(symbol)
-                return symbol, data
-            else:
-                return ticker_symbol, fetcher.get_stock_data(ticker_symbol)
-
-        future_stock = executor.submit(fetch_stock, ticker)
-        
-        # 2. Start fetching news
-        search_query = f"{stock_name} {ticker} 台股 營收 展望 法人 2026"
-        future_news = executor.submit(fetcher.get_news, search_query, 7)
-        
-        # 3. Start fetching institutional data
-        future_inst = executor.submit(fetcher.get_single_stock_institutional_data, ticker)
-
-        # Wait for all futures
-        yf_symbol, stock_data = future_stock.result()
-        news_data = future_news.result()
-        institutional_data = future_inst.result()
+            return symbol, data
+        else:
+            return ticker_symbol, fetcher.get_stock_data(ticker_symbol)
+
+    # TWSE institutional data only exists for numeric Taiwan codes
+    if ticker.isdigit():
+        inst_task = asyncio.to_thread(fetcher.get_single_stock_institutional_data, ticker)
+    else:
+        inst_task = asyncio.sleep(0, result=None)
+
+    # Stock data, news and institutional data are independent blocking calls;
+    # run them in worker threads so the event loop stays free while they wait
+    search_query = f"{stock_name} {ticker} 台股 營收 展望 法人 2026"
+    (yf_symbol, stock_data), news_data, institutional_data = await asyncio.gather(
+        asyncio.to_thread(fetch_stock, ticker),
+        asyncio.to_thread(fetcher.get_news, search_query, 7),
+        inst_task,
+    )
 
     if not stock_data:
         return f"Error generating report: 無法取得 {ticker} 的股價資料。請確認股票代號是否正確，且擁有足夠的近期交易數據。"
@@ -115,24 +132,20 @@ def generate_stock_research(ticker: str) -> str:
     # 5. Generate report with custom prompt
     date_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
-    data_summary = ""
-    if stock_data:
-        data_summary = (
-            f"- {yf_symbol} ({stock_name}): 價格 {stock_data['price']}, "
-            f"漲跌 {stock_data['change']} ({stock_data['pct_change']}%), "
-            f"成交量 {stock_data['volume']}"
-        )
-        if stock_data.get('ma5'):
-            data_summary += f", MA5={stock_data['ma5']}"
-        if stock_data.get('ma20'):
-            data_summary += f", MA20={stock_data['ma20']}"
-        if stock_data.get('rsi') is not None:
-            data_summary += f", RSI={stock_data['rsi']}"
-
-    news_summary = ""
-    if news_data:
-        for item in news_data[:10]:
-            news_summary += f"- {item['title']} ({item['url']})\n"
+    parts = [
+        f"- {yf_symbol} ({stock_name}): 價格 {stock_data['price']}, "
+        f"漲跌 {stock_data['change']} ({stock_data['pct_change']}%), "
+        f"成交量 {stock_data['volume']}"
+    ]
+    if stock_data.get('ma5'):
+        parts.append(f", MA5={stock_data['ma5']}")
+    if stock_data.get('ma20'):
+        parts.append(f", MA20={stock_data['ma20']}")
+    if stock_data.get('rsi') is not None:
+        parts.append(f", RSI={stock_data['rsi']}")
+    data_summary = "".join(parts)
+
+    news_summary = "".join(f"- {item['title']} ({item['url']})\n" for item in (news_data or [])[:10])
 
     # Institutional data for this specific stock
     inst_info = ""
@@ -193,18 +206,35 @@ def generate_stock_research(ticker: str) -> str:
     - 張數：12,634 張（一萬兩千六百三十四張）
     """
 
-    report = analyzer._call_gemini_with_retry(prompt)
-    return report
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        app.state.llm_pool,
+        functools.partial(analyzer._call_gemini_with_retry, prompt, max_total_wait=LLM_MAX_RETRY_WAIT),
+    )
+    try:
+        # shield: a timeout only stops waiting; the worker thread can't be interrupted
+        return await asyncio.wait_for(asyncio.shield(future), timeout=LLM_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        # The Gemini call is already paid for: cache it when it lands so a retry is free
+        future.add_done_callback(functools.partial(_save_late_report, ticker))
+        raise
+
+
+def _save_late_report(ticker: str, future: asyncio.Future):
+    """Done-callback for a generation that finished after its request timed out."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    content = future.result()
+    if content and not content.startswith("Error generating"):
+        save_report(ticker, content)
 
 
 # === Routes ===
 
-@app.get("/", response_class=HTMLResponse)
+@app.get("/")
 async def home():
-    """Serve the frontend."""
-    index_path = os.path.join(static_dir, "index.html")
-    with open(index_path, "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    """Serve the frontend (streamed by the server, with ETag/Last-Modified)."""
+    return FileResponse(_INDEX_PATH, media_type="text/html")
 
 
 @app.get("/api/quota")
@@ -234,24 +264,26 @@ async def research(req: ResearchRequest, request: Request):
     ticker = req.ticker.strip().upper()
     ip = get_client_ip(request)
 
-    # Validate ticker
-    if not ticker or len(ticker) < 2:
+    # Check if ticker contains Chinese characters
+    if _HAN_RE.search(ticker):
         return JSONResponse(
             status_code=400,
-            content={"error": "請輸入有效的股票代號（例如：2330）"}
+            content={"error": "⚠️ 請輸入股票「代號」（例如：2330 或 2543），目前暫不支援直接輸入中文名稱查詢喔！"}
         )
-        
-    # Check if ticker contains Chinese characters
-    if any(u'\u4e00' <= c <= u'\u9fff' for c in ticker):
+
+    # Validate ticker
+    if not _TICKER_RE.fullmatch(ticker):
         return JSONResponse(
             status_code=400,
-            content={"error": "⚠️ 請輸入股票「代號」（例如：2330 或 2543），目前暫不支援直接輸入中文名稱查詢喔！"}
+            content={"error": "請輸入有效的股票代號（例如：2330）"}
         )
 
-    # Check cache first (doesn't cost quota)
-    cached = get_cached_report(ticker)
+    # Cache lookup, quota and global limit are resolved in one transaction;
+    # a quota unit is only consumed when a new report will be generated
+    with borrow() as conn:
+        cached, remaining, global_ok = reserve_slot(conn, ip, ticker)
+
     if cached:
-        remaining = get_remaining_quota(ip)
         stock_name = STOCK_NAMES.get(ticker, ticker)
         return {
             "ticker": ticker,
@@ -263,7 +295,6 @@ async def research(req: ResearchRequest, request: Request):
         }
 
     # Check quota (only for new reports)
-    remaining = get_remaining_quota(ip)
     if remaining <= 0:
         return JSONResponse(
             status_code=429,
@@ -275,7 +306,7 @@ async def research(req: ResearchRequest, request: Request):
         )
 
     # Check global daily limit (protect Gemini API quota)
-    if not check_global_limit():
+    if not global_ok:
         return JSONResponse(
             status_code=503,
             content={
@@ -285,13 +316,12 @@ async def research(req: ResearchRequest, request: Request):
             }
         )
 
-    # Use quota and generate
-    use_quota(ip)
-    remaining = get_remaining_quota(ip)
+    # Quota was consumed by reserve_slot
+    remaining -= 1
 
     try:
         stock_name = STOCK_NAMES.get(ticker, ticker)
-        content = generate_stock_research(ticker)
+        content = await generate_stock_research(ticker)
 
         # Check if Gemini returned an error string instead of a valid report
         if content and content.startswith("Error generating"):
@@ -311,6 +341,15 @@ async def research(req: ResearchRequest, request: Request):
             "remaining_quota": remaining,
             "message": f"✨ 全新生成！已消耗 1 次額度"
         }
+    except asyncio.TimeoutError:
+        # Nothing was delivered, so the quota unit goes back; if the report
+        # still finishes it is cached and the retry is served from cache
+        refund_quota(ip)
+        remaining += 1
+        return JSONResponse(
+            status_code=504,
+            content={"error": "報告生成逾時，請稍後再試。", "remaining_quota": remaining}
+        )
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -0,0 +1,23 @@
+"""
+Stock name mapping (common Taiwan stocks).
+"""
+import types
+
+STOCK_NAMES = types.MappingProxyType({
+    "1301": "台塑", "1303": "南亞", "2002": "中鋼", "2207": "和泰車",
+    "2301": "光寶科", "2303": "聯電", "2308": "台達電", "2312": "金寶",
+    "2317": "鴻海", "2327": "國巨", "2330": "台積電", "2337": "旺宏",
+    "2345": "智邦", "2353": "宏碁", "2354": "鴻準", "2356": "英業達",
+    "2357": "華碩", "2376": "技嘉", "2377": "微星", "2379": "瑞昱",
+    "2382": "廣達", "2395": "研華", "2409": "友達", "2412": "中華電",
+    "2454": "聯發科", "2474": "可成", "2492": "華新科", "2498": "宏達電",
+    "2603": "長榮", "2609": "陽明", "2615": "萬海", "2880": "華南金",
+    "2881": "富邦金", "2882": "國泰金", "2883": "凱基金", "2884": "玉山金",
+    "2885": "元大金", "2886": "兆豐金", "2887": "台新金", "2890": "永豐金",
+    "2891": "中信金", "2892": "第一金", "3008": "大立光", "3034": "聯詠",
+    "3037": "欣興", "3105": "穩懋", "3189": "景碩", "3231": "緯創",
+    "3260": "威剛", "3293": "鈊象", "3443": "創意", "3481": "群創",
+    "3661": "世芯KY", "3711": "日月光", "4904": "遠傳", "4938": "和碩",
+    "5347": "世界", "5871": "中租KY", "6239": "力成", "6415": "矽力KY",
+    "6505": "台塑化", "6669": "緯穎", "8046": "南電", "8454": "富邦媒",
+})
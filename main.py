@@ -42,9 +42,13 @@ def find_previous_report():
 
 
 def main():
+    # One timestamp per run so the header, prompt and filenames always agree
+    now = datetime.datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+
     print(f"{'='*50}")
     print(f"  智慧財經新聞助理 (V21 Pro)")
-    print(f"  日期: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    print(f"  日期: {now.strftime('%Y-%m-%d %H:%M')}")
     print(f"{'='*50}\n")
     
     if not TAVILY_API_KEY or not GEMINI_API_KEY:
@@ -53,7 +57,7 @@ def main():
     
     # Initialize Modules
     fetcher = DataFetcher(TAVILY_API_KEY)
-    analyzer = MarketAnalyzer(GEMINI_API_KEY)
+    analyzer = MarketAnalyzer(GEMINI_API_KEY, semantic_cache=os.getenv("GEMINI_SEMANTIC_CACHE") == "1")
     
     # ========================================
     # 1. Fetch Institutional Data (三大法人 — Top 10 動態排名)
@@ -87,8 +91,7 @@ def main():
     # ========================================
     market_data = {}
     print("\n📊 正在獲取動態股票數據與技術指標...")
-    for symbol in dynamic_symbols:
-        data = fetcher.get_stock_data(symbol)
+    for symbol, data in fetcher.get_many(dynamic_symbols).items():
         if data:
             market_data[symbol] = data
             indicator_str = ""
@@ -195,7 +198,7 @@ def main():
     # 6. Save Report
     # ========================================
     os.makedirs(REPORTS_DIR, exist_ok=True)
-    filename = f"daily_report_V21_{datetime.datetime.now().strftime('%Y-%m-%d')}.md"
+    filename = f"daily_report_V21_{date_str}.md"
     filepath = os.path.join(REPORTS_DIR, filename)
     
     with open(filepath, "w", encoding="utf-8") as f:
@@ -210,7 +213,7 @@ def main():
     structured_data = extract_structured_data(GEMINI_API_KEY, report_content)
     
     # Save the structured data json for debugging
-    json_filename = f"structured_data_{datetime.datetime.now().strftime('%Y%m%d')}.json"
+    json_filename = f"structured_data_{now.strftime('%Y%m%d')}.json"
     json_filepath = os.path.join(REPORTS_DIR, json_filename)
     import json
     with open(json_filepath, "w", encoding="utf-8") as f:
@@ -218,10 +221,9 @@ def main():
     print(f"  ✅ 結構化數據已儲存: {json_filename}")
     
     print("\n🎧 正在基於結構化數據生成 NotebookLM Podcast 腳本指令...")
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
     print(f"  📌 目前專案主題標籤: {PROJECT_THEME if PROJECT_THEME else '無 (日常盤勢)'}")
     notebooklm_prompt_content = generate_notebooklm_prompt(GEMINI_API_KEY, structured_data, date_str, current_theme=PROJECT_THEME)
-    nl_filename = f"notebooklm_prompt_podcast_{datetime.datetime.now().strftime('%Y%m%d')}.md"
+    nl_filename = f"notebooklm_prompt_podcast_{now.strftime('%Y%m%d')}.md"
     nl_filepath = os.path.join(REPORTS_DIR, nl_filename)
     
     with open(nl_filepath, "w", encoding="utf-8") as f:
@@ -1,9 +1,11 @@
 import os
+import asyncio
 import datetime
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from modules.data_fetcher import DataFetcher
+from modules.data_fetcher import DataFetcher, news_url_key
 from modules.analyzer import MarketAnalyzer
+from modules.file_utils import list_reports, atomic_open, open_report, compress_old_reports
 
 # Load environment variables from .env
 load_dotenv()
@@ -29,15 +31,20 @@ US_TOPICS = [
     "Federal Reserve interest rate 2026",
 ]
 
+# Cap concurrent Yahoo requests to stay clear of rate limiting
+MAX_FETCH_WORKERS = 8
+MAX_NEWS_WORKERS = 6
+
+# Daily reports older than this are gzipped after each run
+REPORT_ARCHIVE_DAYS = 30
+
 # Reports directory
 REPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
 
 
 def find_previous_us_report():
     """Find the most recent US report for historical comparison."""
-    if not os.path.exists(REPORTS_DIR):
-        return None
-    reports = sorted(glob.glob(os.path.join(REPORTS_DIR, "us_market_report_*.md")))
+    reports = list_reports(REPORTS_DIR, "us_market_report_", (".md", ".md.gz"))
     if reports:
         latest = reports[-1]
         print(f"  找到前日美股報告: {os.path.basename(latest)}")
@@ -45,23 +52,27 @@ def find_previous_us_report():
     return None
 
 
-def generate_us_prompt(date_str, data_summary, news_summary, hist_section=""):
-    """Custom prompt for US market report with Taiwan investor perspective."""
-    return f"""
+def load_hist_section():
+    """Returns the previous US report excerpt for the prompt, or "" if there is none."""
+    prev_report = find_previous_us_report()
+    if not prev_report:
+        return ""
+    try:
+        with open_report(prev_report) as f:
+            return f"\n# 前日報告（供比較用）\n{f.read(2000)}\n"
+    except Exception:
+        return ""
+
+
+# Static instructions, sent as the system instruction so Gemini can cache them
+US_REPORT_INSTRUCTIONS = """
     You are a professional financial analyst helping Taiwan investors track the US market during Lunar New Year break.
-    Create a US market OBSERVATION report for {date_str} in Traditional Chinese (繁體中文) Markdown format.
+    Create a US market OBSERVATION report for the given date in Traditional Chinese (繁體中文) Markdown format.
     
     This report is produced during the Taiwan stock market Lunar New Year break (春節休市).
     The goal is to help Taiwan investors TRACK daily changes — NOT to make final predictions,
     since the market may change significantly before TWSE reopens.
     
-    # 美股數據（含技術指標）
-    {data_summary}
-    
-    # 相關新聞
-    {news_summary}
-    {hist_section}
-    
     # 報告要求
     1. **美股快照**: 建立 Markdown 表格，欄位：代碼, 名稱, 價格, 漲跌, 漲跌幅, 成交量, MA5, MA20, RSI。
     2. **重點觀察 — 台積電 ADR (TSM)**: 分析 TSM 最新表現與技術指標，說明目前 ADR 相對台股封關價的狀態。
@@ -72,7 +83,7 @@ def generate_us_prompt(date_str, data_summary, news_summary, hist_section=""):
        - **嚴禁使用**「預期將...」「必定...」「建議買入/賣出」等斷言式用語
        - 明確提醒：「春節期間美股仍在交易中，趨勢隨時可能反轉，本報告僅為當日觀察紀錄。」
        - 列出「目前對台股有利的訊號」和「目前對台股不利的訊號」兩組，讓觀眾自行判斷
-    {"6. **與前日比較**: 用表格對比今日與前日數據的變化，標註趨勢方向。" if hist_section else ""}
+    6. **與前日比較**（僅在有提供前日報告時）: 用表格對比今日與前日數據的變化，標註趨勢方向。
     7. **語氣**: 像寫「觀察日記」而非「投資報告」。專業但謙遜，承認不確定性。
     8. **格式**: 乾淨的 Markdown。
     9. **數字格式（重要！）**: 在報告正文（非表格）中提及關鍵數字時，在阿拉伯數字後加上中文括號標註，以確保語音朗讀正確。範例：
@@ -84,10 +95,37 @@ def generate_us_prompt(date_str, data_summary, news_summary, hist_section=""):
     """
 
 
-def main():
+# Per-run payload, filled with str.format_map in generate_us_prompt
+_US_PROMPT_TMPL = """
+    報告日期：{date_str}
+    
+    # 美股數據（含技術指標）
+    {data_summary}
+    
+    # 相關新聞
+    {news_summary}
+    {hist_section}
+    """
+
+
+def generate_us_prompt(date_str, data_summary, news_summary, hist_section=""):
+    """Per-run data for the US market report; pair with US_REPORT_INSTRUCTIONS."""
+    return _US_PROMPT_TMPL.format_map({
+        "date_str": date_str,
+        "data_summary": data_summary,
+        "news_summary": news_summary,
+        "hist_section": hist_section,
+    })
+
+
+async def main():
+    # One timestamp per run so the header, prompt and filenames always agree
+    now = datetime.datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+
     print(f"{'='*50}")
     print(f"  🇺🇸 春節美股觀察報告")
-    print(f"  日期: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    print(f"  日期: {now.strftime('%Y-%m-%d %H:%M')}")
     print(f"{'='*50}\n")
     
     if not TAVILY_API_KEY or not GEMINI_API_KEY:
@@ -95,15 +133,31 @@ def main():
         return
     
     fetcher = DataFetcher(TAVILY_API_KEY)
-    analyzer = MarketAnalyzer(GEMINI_API_KEY)
+    analyzer = MarketAnalyzer(GEMINI_API_KEY, semantic_cache=os.getenv("GEMINI_SEMANTIC_CACHE") == "1")
     
     # ========================================
-    # 1. Fetch US Market Data
+    # 1-3. Fetch market data, news and the previous report concurrently
+    # ========================================
+    print("📊 正在同時獲取美股數據、相關新聞與前日報告...")
+    loop = asyncio.get_running_loop()
+    queries = [f"{topic} market news today" for topic in US_TOPICS]
+    with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(US_SYMBOLS))) as stock_pool, \
+            ThreadPoolExecutor(max_workers=min(MAX_NEWS_WORKERS, len(queries))) as news_pool:
+        results = await asyncio.gather(
+            *(loop.run_in_executor(stock_pool, fetcher.get_stock_data, symbol) for symbol in US_SYMBOLS),
+            *(loop.run_in_executor(news_pool, fetcher.get_news, query) for query in queries),
+            asyncio.to_thread(load_hist_section),
+        )
+    stock_results = results[:len(US_SYMBOLS)]
+    topic_results = results[len(US_SYMBOLS):-1]
+    hist_section = results[-1]
+
+    # ========================================
+    # 1. US Market Data
     # ========================================
     market_data = {}
-    print("📊 正在獲取美股數據與技術指標...")
-    for symbol in US_SYMBOLS:
-        data = fetcher.get_stock_data(symbol)
+    print("\n📊 美股數據與技術指標:")
+    for symbol, data in zip(US_SYMBOLS, stock_results):
         if data:
             market_data[symbol] = data
             indicator_str = ""
@@ -118,75 +172,73 @@ def main():
             print(f"  ❌ {symbol}: 失敗")
     
     # ========================================
-    # 2. Fetch News
+    # 2. News
     # ========================================
-    news_data = []
-    print("\n📰 正在獲取美股相關新聞...")
-    for topic in US_TOPICS:
-        query = f"{topic} market news today"
-        results = fetcher.get_news(query)
+    unique_news = []
+    print("\n📰 美股相關新聞:")
+    seen_urls = set()  # keyed by news_url_key: links differing only in tracking params collapse
+    for topic, results in zip(US_TOPICS, topic_results):
         if results:
-            news_data.extend(results)
+            # Deduplicate across topics as results come in (first occurrence wins)
+            for item in results:
+                url = item.get('url')
+                key = news_url_key(url) if url else None
+                if key and key not in seen_urls:
+                    seen_urls.add(key)
+                    unique_news.append(item)
             print(f"  ✅ {topic}: 找到 {len(results)} 篇文章")
         else:
             print(f"  ⚠️  {topic}: 未找到文章")
-    
-    # Deduplicate
-    unique_news = list({n['url']: n for n in news_data}.values())
     print(f"\n  📋 獨特新聞文章總數: {len(unique_news)}")
     
     # ========================================
     # 3. Historical Comparison
     # ========================================
-    print("\n📁 檢查歷史報告...")
-    prev_report = find_previous_us_report()
-    hist_section = ""
-    if prev_report:
-        try:
-            with open(prev_report, "r", encoding="utf-8") as f:
-                hist_section = f"\n# 前日報告（供比較用）\n{f.read()[:2000]}\n"
-        except Exception:
-            pass
+    print(f"\n📁 歷史報告: {'已載入前日報告' if hist_section else '無前日報告'}")
     
     # ========================================
     # 4. Prepare Data & Generate Report
     # ========================================
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-    
-    data_summary = ""
+    parts = []
     for symbol, data in market_data.items():
         if data:
-            line = f"- {symbol}: 價格 {data['price']}, 漲跌 {data['change']} ({data['pct_change']}%), 成交量 {data['volume']}"
+            parts.append(f"- {symbol}: 價格 {data['price']}, 漲跌 {data['change']} ({data['pct_change']}%), 成交量 {data['volume']}")
             if data.get('ma5'):
-                line += f", MA5={data['ma5']}"
+                parts.append(f", MA5={data['ma5']}")
             if data.get('ma20'):
-                line += f", MA20={data['ma20']}"
+                parts.append(f", MA20={data['ma20']}")
             if data.get('rsi') is not None:
-                line += f", RSI={data['rsi']}"
-            data_summary += line + "\n"
+                parts.append(f", RSI={data['rsi']}")
+            parts.append("\n")
+    data_summary = "".join(parts)
     
-    news_summary = ""
-    for item in unique_news:
-        news_summary += f"- {item['title']} ({item['url']})\n"
+    news_summary = "".join(f"- {item['title']} ({item['url']})\n" for item in unique_news)
     
     prompt = generate_us_prompt(date_str, data_summary, news_summary, hist_section)
     
-    print("\n🤖 正在使用 Gemini 生成美股觀察報告...")
-    report_content = analyzer._call_gemini_with_retry(prompt)
-    
     # ========================================
-    # 5. Save Report
+    # 5. Generate & Save Report (streamed straight to disk)
     # ========================================
     os.makedirs(REPORTS_DIR, exist_ok=True)
     filename = f"us_market_report_{date_str}.md"
     filepath = os.path.join(REPORTS_DIR, filename)
     
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(report_content)
+    def write_report():
+        with atomic_open(filepath) as f:
+            analyzer._call_gemini_stream(prompt, f, system_instruction=US_REPORT_INSTRUCTIONS,
+                                          semantic_namespace=f"us_report:{date_str}",
+                                          semantic_exact=data_summary)
+
+    print("\n🤖 正在使用 Gemini 生成美股觀察報告...")
+    await asyncio.to_thread(write_report)
     
     print(f"\n✅ 美股觀察報告已儲存至: {filepath}")
+
+    archived = compress_old_reports(REPORTS_DIR, "us_market_report_", REPORT_ARCHIVE_DAYS, today=now.date())
+    if archived:
+        print(f"  🗜️  已壓縮 {archived} 份超過 {REPORT_ARCHIVE_DAYS} 天的舊報告")
     print("完成!")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
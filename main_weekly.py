@@ -1,10 +1,11 @@
 import os
+import asyncio
 import datetime
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from modules.data_fetcher import DataFetcher
+from modules.data_fetcher import DataFetcher, news_url_key
 from modules.analyzer import MarketAnalyzer
-from modules.thumbnail_generator import generate_ab_test_thumbnails, print_ab_test_summary
+from modules.file_utils import list_reports, atomic_open, open_report
 
 # Load environment variables from .env
 load_dotenv()
@@ -32,56 +33,49 @@ US_TOPICS = [
     "S&P 500 NASDAQ weekly performance",
 ]
 
+# Cap concurrent Yahoo requests to stay clear of rate limiting
+MAX_FETCH_WORKERS = 8
+MAX_NEWS_WORKERS = 6
+
+# Only the last week of daily reports is relevant for the weekly recap
+DAILY_CONTEXT_REPORTS = 7
+
 # Reports directory
 REPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
 
 
 def load_existing_daily_reports():
-    """Load all existing US daily reports from the封關 period as context."""
-    if not os.path.exists(REPORTS_DIR):
-        return ""
-
-    reports = sorted(glob.glob(os.path.join(REPORTS_DIR, "us_market_report_*.md")))
+    """Load the most recent US daily reports from the封關 period as context."""
+    reports = list_reports(REPORTS_DIR, "us_market_report_", (".md", ".md.gz"))[-DAILY_CONTEXT_REPORTS:]
     if not reports:
         return ""
 
     combined = ""
     for report_path in reports:
         try:
-            date_part = os.path.basename(report_path).replace("us_market_report_", "").replace(".md", "")
-            with open(report_path, "r", encoding="utf-8") as f:
-                content = f.read()
-            combined += f"\n--- {date_part} 的每日觀察 ---\n{content[:1500]}\n"
-            print(f"  📄 已載入: {os.path.basename(report_path)}")
+            name = os.path.basename(report_path)
+            date_part = name.replace("us_market_report_", "").replace(".md.gz", "").replace(".md", "")
+            # Only the first 1500 characters go into the prompt
+            with open_report(report_path) as f:
+                content = f.read(1500)
+            combined += f"\n--- {date_part} 的每日觀察 ---\n{content}\n"
+            print(f"  📄 已載入: {name}")
         except Exception:
             pass
 
     return combined
 
 
-def generate_weekly_prompt(date_str, weekly_data_summary, news_summary, daily_reports_context):
-    """
-    Custom prompt for weekly US market video script.
-    Designed for NotebookLM podcast/video generation — narrative style.
-    """
-    return f"""
+# Static instructions, sent as the system instruction so Gemini can cache them
+WEEKLY_SCRIPT_INSTRUCTIONS = """
     You are a professional financial content creator helping produce a Taiwan investor YouTube video script.
     The video is about the US stock market recap for the week before Taiwan stock market reopens after Lunar New Year break.
 
-    Today is {date_str} (Sunday). Taiwan stock market reopens tomorrow (Monday) at 9:00 AM.
+    The script is produced on a Sunday. Taiwan stock market reopens the next day (Monday) at 9:00 AM.
     The Taiwan market was closed for the entire Lunar New Year week.
 
     Please write the script in **Traditional Chinese (繁體中文)**.
 
-    # === 本週美股數據（含每日走勢） ===
-    {weekly_data_summary}
-
-    # === 本週相關新聞 ===
-    {news_summary}
-
-    # === 封關期間每日觀察報告（參考用） ===
-    {daily_reports_context if daily_reports_context else "（無每日報告資料）"}
-
     # === 文案撰寫要求 ===
 
     ## 風格與語氣
@@ -144,10 +138,42 @@ def generate_weekly_prompt(date_str, weekly_data_summary, news_summary, daily_re
     """
 
 
-def main():
+# Per-run payload, filled with str.format_map in generate_weekly_prompt
+_WEEKLY_PROMPT_TMPL = """
+    Today is {date_str} (Sunday). Taiwan stock market reopens tomorrow (Monday) at 9:00 AM.
+
+    # === 本週美股數據（含每日走勢） ===
+    {weekly_data_summary}
+
+    # === 本週相關新聞 ===
+    {news_summary}
+
+    # === 封關期間每日觀察報告（參考用） ===
+    {daily_reports_context}
+    """
+
+
+def generate_weekly_prompt(date_str, weekly_data_summary, news_summary, daily_reports_context):
+    """
+    Per-run data for the weekly US market video script; pair with WEEKLY_SCRIPT_INSTRUCTIONS.
+    Designed for NotebookLM podcast/video generation — narrative style.
+    """
+    return _WEEKLY_PROMPT_TMPL.format_map({
+        "date_str": date_str,
+        "weekly_data_summary": weekly_data_summary,
+        "news_summary": news_summary,
+        "daily_reports_context": daily_reports_context or "（無每日報告資料）",
+    })
+
+
+async def main():
+    # One timestamp per run so the header, prompt and filenames always agree
+    now = datetime.datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+
     print(f"{'='*60}")
     print(f"  🇺🇸 春節封關一週美股回顧 ＋ 台股開盤展望")
-    print(f"  日期: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    print(f"  日期: {now.strftime('%Y-%m-%d %H:%M')}")
     print(f"  模式: 週報型文案（NotebookLM 影片用）")
     print(f"{'='*60}\n")
 
@@ -155,16 +181,36 @@ def main():
         print("[Error] 請在 .env 檔案中設定 TAVILY_API_KEY 和 GEMINI_API_KEY")
         return
 
+    # Deferred: pulls in the google.genai SDK, only needed once the keys check out
+    from modules.thumbnail_generator import generate_ab_test_thumbnails, print_ab_test_summary
+
     fetcher = DataFetcher(TAVILY_API_KEY)
-    analyzer = MarketAnalyzer(GEMINI_API_KEY)
+    analyzer = MarketAnalyzer(GEMINI_API_KEY, semantic_cache=os.getenv("GEMINI_SEMANTIC_CACHE") == "1")
 
     # ========================================
-    # 1. Fetch Weekly US Market Data
+    # 1-3. Fetch weekly data, the week's news and daily reports concurrently
+    # ========================================
+    print("📊 正在同時獲取一週美股數據、本週新聞與封關期間每日觀察報告...")
+    loop = asyncio.get_running_loop()
+    queries = [f"{topic} market news this week" for topic in US_TOPICS]
+    with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(US_SYMBOLS))) as stock_pool, \
+            ThreadPoolExecutor(max_workers=min(MAX_NEWS_WORKERS, len(queries))) as news_pool:
+        results = await asyncio.gather(
+            *(loop.run_in_executor(stock_pool, lambda s=symbol: fetcher.get_weekly_stock_data(s, trading_days=5))
+              for symbol in US_SYMBOLS),
+            *(loop.run_in_executor(news_pool, lambda q=query: fetcher.get_news(q, days=7)) for query in queries),
+            asyncio.to_thread(load_existing_daily_reports),
+        )
+    stock_results = results[:len(US_SYMBOLS)]
+    topic_results = results[len(US_SYMBOLS):-1]
+    daily_reports_context = results[-1]
+
+    # ========================================
+    # 1. Weekly US Market Data
     # ========================================
     weekly_data = {}
-    print("📊 正在獲取一週美股數據（每日收盤序列）...")
-    for symbol in US_SYMBOLS:
-        data = fetcher.get_weekly_stock_data(symbol, trading_days=5)
+    print("\n📊 一週美股數據（每日收盤序列）:")
+    for symbol, data in zip(US_SYMBOLS, stock_results):
         if data:
             weekly_data[symbol] = data
             print(f"  ✅ {symbol}: 週收 ${data['week_close']} "
@@ -175,89 +221,84 @@ def main():
             print(f"  ❌ {symbol}: 失敗")
 
     # ========================================
-    # 2. Fetch Week's News (expanded range)
+    # 2. Week's News (expanded range)
     # ========================================
-    news_data = []
-    print("\n📰 正在獲取本週美股相關新聞...")
-    for topic in US_TOPICS:
-        query = f"{topic} market news this week"
-        results = fetcher.get_news(query, days=7)
+    unique_news = []
+    print("\n📰 本週美股相關新聞:")
+    seen_urls = set()  # keyed by news_url_key: links differing only in tracking params collapse
+    for topic, results in zip(US_TOPICS, topic_results):
         if results:
-            news_data.extend(results)
+            # Deduplicate across topics as results come in (first occurrence wins)
+            for item in results:
+                url = item.get('url')
+                key = news_url_key(url) if url else None
+                if key and key not in seen_urls:
+                    seen_urls.add(key)
+                    unique_news.append(item)
             print(f"  ✅ {topic}: 找到 {len(results)} 篇文章")
         else:
             print(f"  ⚠️  {topic}: 未找到文章")
-
-    # Deduplicate
-    unique_news = list({n['url']: n for n in news_data}.values())
     print(f"\n  📋 獨特新聞文章總數: {len(unique_news)}")
 
-    # ========================================
-    # 3. Load Existing Daily Reports
-    # ========================================
-    print("\n📁 載入封關期間每日觀察報告...")
-    daily_reports_context = load_existing_daily_reports()
-
     # ========================================
     # 4. Prepare Data Summary
     # ========================================
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-
     # Build weekly data summary with daily series
-    weekly_data_summary = ""
+    parts = []
     for symbol, data in weekly_data.items():
-        weekly_data_summary += f"\n## {symbol}\n"
-        weekly_data_summary += (
+        parts.append(f"\n## {symbol}\n")
+        parts.append(
             f"- 週收盤: {data['week_close']}, "
             f"週漲跌: {data['week_change']} ({data['week_pct_change']}%)\n"
             f"- 週內最高: {data['week_high']}, 週內最低: {data['week_low']}\n"
             f"- 均量: {data['avg_volume']:,}\n"
             f"- 技術指標: MA5={data['ma5']}, MA20={data['ma20']}, RSI={data['rsi']}\n"
         )
-        weekly_data_summary += "- 每日走勢:\n"
-        for day in data['daily_series']:
-            weekly_data_summary += (
-                f"  - {day['date']}: 收 {day['close']} "
-                f"({day['pct_change']:+.2f}%) 量 {day['volume']:,}\n"
-            )
+        parts.append("- 每日走勢:\n")
+        parts.extend(
+            f"  - {day['date']}: 收 {day['close']} "
+            f"({day['pct_change']:+.2f}%) 量 {day['volume']:,}\n"
+            for day in data['daily_series']
+        )
+    weekly_data_summary = "".join(parts)
 
     # News summary
-    news_summary = ""
-    for item in unique_news:
-        title = item.get('title', 'No title')
-        url = item.get('url', '')
-        news_summary += f"- {title} ({url})\n"
+    news_summary = "".join(
+        f"- {item.get('title', 'No title')} ({item.get('url', '')})\n" for item in unique_news
+    )
 
     # ========================================
-    # 5. Generate Video Script via Gemini
+    # 5-7. Generate Video Script & YouTube Thumbnails (A/B Test) concurrently
     # ========================================
     prompt = generate_weekly_prompt(date_str, weekly_data_summary, news_summary, daily_reports_context)
+    # Titles only need the week's key numbers, so seed them from the data instead of waiting for the script
+    thumbnail_seed = f"封關一週美股回顧（{date_str}）\n{weekly_data_summary[:800]}"
 
-    print("\n🤖 正在使用 Gemini 生成週報型影片文案...")
-    report_content = analyzer._call_gemini_with_retry(prompt)
-
-    # ========================================
-    # 6. Save Report
-    # ========================================
     os.makedirs(REPORTS_DIR, exist_ok=True)
     filename = f"weekly_us_report_{date_str}.md"
     filepath = os.path.join(REPORTS_DIR, filename)
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(report_content)
+    def write_report():
+        # Streamed straight to disk
+        with atomic_open(filepath) as f:
+            analyzer._call_gemini_stream(prompt, f, system_instruction=WEEKLY_SCRIPT_INSTRUCTIONS,
+                                          semantic_namespace=f"weekly_script:{date_str}",
+                                          semantic_exact=weekly_data_summary)
 
+    print("\n🤖 正在使用 Gemini 生成週報型影片文案...")
+    print("🎬 同時生成 YouTube 縮圖與標題（A/B Test）...")
+    _, ab_results = await asyncio.gather(
+        asyncio.to_thread(write_report),
+        asyncio.to_thread(
+            generate_ab_test_thumbnails,
+            api_key=GEMINI_API_KEY,
+            report_content=thumbnail_seed,
+            reports_dir=REPORTS_DIR,
+            num_titles=3,
+        ),
+    )
     print(f"\n✅ 週報文案已儲存至: {filepath}")
 
-    # ========================================
-    # 7. Generate YouTube Thumbnails (A/B Test)
-    # ========================================
-    print("\n🎬 開始生成 YouTube 縮圖與標題（A/B Test）...")
-    ab_results = generate_ab_test_thumbnails(
-        api_key=GEMINI_API_KEY,
-        report_content=report_content,
-        reports_dir=REPORTS_DIR,
-        num_titles=3,
-    )
     print_ab_test_summary(ab_results)
 
     print("✅ 全部完成! 你可以：")
@@ -266,4 +307,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
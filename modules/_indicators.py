@@ -0,0 +1,60 @@
+"""
+Compiled kernels for technical indicators.
+Prefers numba; without it, falls back to scipy's C IIR filter, then plain Python.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        # Support both @njit and @njit(...)
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn
+
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+
+@njit(cache=True, fastmath=True)
+def _wilder_rsi_loop(gains, losses, period):
+    """Wilder smoothing of gains/losses; returns the final (avg_gain, avg_loss)."""
+    avg_gain = gains[:period].mean()
+    avg_loss = losses[:period].mean()
+    for i in range(period, len(gains)):
+        avg_gain = (avg_gain * (period - 1) + gains[i]) / period
+        avg_loss = (avg_loss * (period - 1) + losses[i]) / period
+    return avg_gain, avg_loss
+
+
+def _wilder_rsi_lfilter(gains, losses, period):
+    """
+    Same recurrence as _wilder_rsi_loop, written as the IIR filter
+    y[i] = (1 - 1/period) * y[i-1] + x[i] / period seeded with the SMA,
+    so both series are smoothed in one C-level lfilter call.
+    """
+    seeds = np.array([gains[:period].mean(), losses[:period].mean()])
+    if len(gains) == period:
+        return seeds[0], seeds[1]
+    decay = (period - 1.0) / period
+    smoothed, _ = lfilter(
+        [1.0 / period], [1.0, -decay],
+        np.vstack((gains[period:], losses[period:])),
+        axis=1, zi=(decay * seeds)[:, np.newaxis],
+    )
+    return smoothed[0, -1], smoothed[1, -1]
+
+
+if HAVE_NUMBA or lfilter is None:
+    _wilder_rsi = _wilder_rsi_loop
+else:
+    _wilder_rsi = _wilder_rsi_lfilter
+
+# Compile (or load from the on-disk cache) now rather than on the first request
+_wilder_rsi(np.zeros(16), np.zeros(16), 14)
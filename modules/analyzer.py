@@ -1,187 +1,228 @@
 import os
-import google.generativeai as genai
 import datetime
+import functools
 import time
 import json
+import hashlib
+import tempfile
+import threading
+import random
+import re
+import numpy as np
+
+try:
+    import orjson  # optional: faster (de)serialisation of the semantic cache
+except ImportError:
+    orjson = None
+
+# google.generativeai (grpc, protobuf, ...) is imported inside the methods that
+# need it, so scripts that exit early (e.g. missing API key) don't pay for it.
+
+# Exact-match prompt cache (opt-in via GEMINI_CACHE=1)
+GEMINI_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports", ".gemini_cache")
+GEMINI_CACHE_TTL = 86400
+
+# Retry backoff: full jitter over min(RETRY_MAX_BACKOFF, RETRY_BASE_WAIT * 2**attempt)
+RETRY_BASE_WAIT = 10
+RETRY_MAX_BACKOFF = 60
+_RETRY_HINT_RES = (
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _retryable_exceptions():
+    """Gemini error classes worth retrying; empty if google.api_core is unavailable."""
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return ()
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    )
+
+
+def _retry_hint_seconds(e):
+    """Returns the server-suggested retry delay carried by a Gemini error, if any."""
+    for detail in getattr(e, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    error_str = str(e)
+    for pattern in _RETRY_HINT_RES:
+        match = pattern.search(error_str)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def _json_line(obj):
+    """One UTF-8 encoded JSON Lines record."""
+    if orjson is not None:
+        return orjson.dumps(obj) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+# Explicit context caching of static system instructions (opt-in via GEMINI_CONTEXT_CACHE=1)
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+# After a failed registration the plain model is used for this long, then it is retried
+CONTEXT_CACHE_RETRY_AFTER = 600
+
+# Embedding-based near-duplicate prompt cache (opt-in per analyzer, batch scripts only)
+SEMANTIC_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports", ".semcache")
+SEMANTIC_CACHE_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_TASK = "SEMANTIC_SIMILARITY"
+EMBED_BATCH_SIZE = 100  # per-request limit of the batch embedding endpoint
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+
+class SemanticCache:
+    """
+    Reuses a response when a new prompt is nearly identical (cosine >= threshold)
+    to one answered earlier the same day, e.g. a rerun where only a news URL changed.
+    Callers put the exact-match parts (namespace, numeric data) into `key`:
+    embeddings can't tell two prompts apart that differ only in a few numbers.
+    Embeddings live in embeddings.npy (unit-normalised, float32), entries in entries.jsonl.
+    Entries from previous days are dropped so yesterday's report is never served.
+    The two files are replaced one after the other, so they can get out of
+    step after a crash; if their row counts differ on load, the kept prompts
+    are re-embedded in batches.
+    """
+
+    def __init__(self, cache_dir=SEMANTIC_CACHE_DIR, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.emb_path = os.path.join(cache_dir, "embeddings.npy")
+        self.entries_path = os.path.join(cache_dir, "entries.jsonl")
+        self._lock = threading.Lock()
+        self._date = datetime.date.today().isoformat()
+        self.embeddings = None   # np.ndarray (N, D)
+        self.entries = []        # [{"date", "key", "prompt", "response"}]
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.entries_path, "rb") as f:
+                entries = [_json_loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            return
+        keep = [i for i, e in enumerate(entries) if e.get("date") == self._date]
+        if not keep:
+            return
+        kept_entries = [entries[i] for i in keep]
 
-class MarketAnalyzer:
-    def __init__(self, api_key):
-        genai.configure(api_key=api_key)
-        # 讀取環境變數，本地端預設可設為 gemini-pro-latest，網站端若未設定則預設使用 gemini-flash-latest
-        model_name = os.getenv("GEMINI_MODEL", "gemini-flash-latest")
-        self.model = genai.GenerativeModel(model_name)
-        self.stock_db = self._load_stock_db()
-
-    def _load_stock_db(self):
-        db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "stock_db.json")
         try:
-            with open(db_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            embeddings = np.load(self.emb_path)
+        except (OSError, ValueError):
+            embeddings = None
+        # Row counts must agree, otherwise the files were written by different _persist calls
+        if embeddings is not None and len(embeddings) == len(entries):
+            self.embeddings = embeddings[keep]
+            self.entries = kept_entries
+            return
+
+        # Bootstrap: rebuild the missing/mismatched embeddings from the stored prompts
+        try:
+            self.embeddings = self.embed_many([e["prompt"] for e in kept_entries])
         except Exception as e:
-            print(f"[Warning] Could not load stock_db.json: {e}")
-            return {}
-
-
-    def _call_gemini_with_retry(self, prompt, max_retries=3):
-        """
-        Calls Gemini with exponential backoff retry on 429/5xx errors.
-        Retries: 10s, 30s, 60s
-        """
-        wait_times = [10, 30, 60]
-        
-        for attempt in range(max_retries + 1):
-            try:
-                response = self.model.generate_content(prompt)
-                return response.text
-            except Exception as e:
-                error_str = str(e)
-                is_retryable = "429" in error_str or "500" in error_str or "503" in error_str
-                
-                if is_retryable and attempt < max_retries:
-                    wait = wait_times[attempt]
-                    print(f"  [Retry] Gemini API 錯誤 (嘗試 {attempt + 1}/{max_retries})，等待 {wait} 秒後重試...")
-                    time.sleep(wait)
-                else:
-                    return f"Error generating report: {e}"
+            print(f"  [Warning] 語意快取重建失敗，已忽略: {e}")
+            return
+        self.entries = kept_entries
+        print(f"  [Info] 語意快取已重建 {len(kept_entries)} 筆向量")
+        self._persist()
+
+    def _roll_date(self):
+        today = datetime.date.today().isoformat()
+        if today != self._date:
+            self._date = today
+            self.embeddings = None
+            self.entries = []
+
+    @staticmethod
+    def embed_many(texts):
+        """Unit-normalised (N, D) embeddings, one API round-trip per EMBED_BATCH_SIZE texts."""
+        import google.generativeai as genai
+        rows = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            result = genai.embed_content(
+                model=SEMANTIC_CACHE_MODEL,
+                content=texts[i:i + EMBED_BATCH_SIZE],
+                task_type=SEMANTIC_CACHE_TASK,
+            )
+            rows.extend(result["embedding"])
+        embs = np.asarray(rows, dtype=np.float32)
+        norms = np.linalg.norm(embs, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embs / norms
+
+    @classmethod
+    def embed(cls, text):
+        return cls.embed_many([text])[0]
+
+    def lookup(self, emb, key):
+        """Returns the best same-day response for `key` if its similarity clears the threshold."""
+        with self._lock:
+            self._roll_date()
+            if self.embeddings is None:
+                return None
+            sims = np.dot(self.embeddings, emb)
+            sims[np.asarray([e["key"] for e in self.entries]) != key] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                return self.entries[best]["response"]
+        return None
+
+    def add(self, emb, key, prompt, response):
+        with self._lock:
+            self._roll_date()
+            entry = {"date": self._date, "key": key, "prompt": prompt, "response": response}
+            if self.embeddings is None:
+                self.embeddings = emb[np.newaxis, :]
+            else:
+                self.embeddings = np.vstack([self.embeddings, emb])
+            self.entries.append(entry)
+            self._persist()
 
-    def generate_report(self, market_data, news_data, institutional_data=None, prev_report_path=None, commodity_data=None, macro_events=None, tech_catalyst_events=None, volume_data=None):
+    def _persist(self):
         """
-        Generates a Markdown report using Gemini with enhanced data.
+        Rewrites each file via temp file + os.replace, so neither is ever half
+        written. The pair is not replaced atomically; _load checks row counts.
         """
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-        
-        # === Stock Data Summary ===
-        data_summary = ""
-        for symbol, data in market_data.items():
-            if data:
-                line = f"- {symbol}: 價格 {data['price']}, 漲跌 {data['change']} ({data['pct_change']}%), 成交量 {data['volume']} (5日均量 {data.get('avg_vol_5d', 'N/A')}, 量增比 {data.get('vol_ratio', 'N/A')}x)"
-                if data.get('ma5'):
-                    line += f", MA5={data['ma5']}"
-                if data.get('ma20'):
-                    line += f", MA20={data['ma20']}"
-                if data.get('rsi') is not None:
-                    line += f", RSI={data['rsi']}"
-                data_summary += line + "\n"
-            else:
-                data_summary += f"- {symbol}: 數據無法取得\n"
-                
-        # === News Summary ===
-        news_summary = ""
-        for item in news_data:
-            news_summary += f"- {item['title']} ({item['url']})\n"
-            
-        # === Institutional Data Summary (with dollar amounts) ===
-        inst_summary = ""
-        if institutional_data and (institutional_data.get("top_buy") or institutional_data.get("top_sell")):
-            data_date = institutional_data.get("data_date", "未知")
-            inst_summary = f"\n# 三大法人買賣超（依金額排序 - 資料日期：{data_date}）\n"
-            inst_summary += "\n## 外資買超前10名（依估計金額排序）\n"
-            for s in institutional_data.get("top_buy", []):
-                amt = s.get('est_amount', 0)
-                amt_str = f", 估計金額 {amt:+.1f}億" if amt else ""
-                inst_summary += f"- {s['id']} {s['name']}: 外資 {s['foreign_net']:+,}股, 投信 {s['trust_net']:+,}股, 合計 {s['total_net']:+,}股{amt_str}\n"
-            inst_summary += "\n## 外資賣超前10名（依估計金額排序）\n"
-            for s in institutional_data.get("top_sell", []):
-                amt = s.get('est_amount', 0)
-                amt_str = f", 估計金額 {amt:+.1f}億" if amt else ""
-                inst_summary += f"- {s['id']} {s['name']}: 外資 {s['foreign_net']:+,}股, 投信 {s['trust_net']:+,}股, 合計 {s['total_net']:+,}股{amt_str}\n"
-        
-        # === Commodity Data ===
-        commodity_summary = ""
-        if commodity_data:
-            commodity_summary = "\n# 國際商品行情\n"
-            for sym, cdata in commodity_data.items():
-                commodity_summary += f"- {cdata['name']}: ${cdata['price']} ({cdata['pct_change']:+.2f}%)\n"
-        
-        # === Macro Events ===
-        macro_summary = ""
-        if macro_events:
-            macro_summary = "\n# 近期全球重要總經事件與財曆 (Macro Calendar)\n"
-            for item in macro_events:
-                macro_summary += f"- {item['title']} ({item['url']})\n"
-                
-        # === Tech Catalyst Events ===
-        catalyst_summary = ""
-        if tech_catalyst_events:
-            catalyst_summary = "\n# 重大科技/總經催化劍事件（趁近 14 天）\n"
-            for ev in tech_catalyst_events:
-                catalyst_summary += f"- {ev['event']}\n  └→ {ev['snippet']}\n"
-
-        # === Volume Ranking Data (今日成交量排名 - 真實市場投票) ===
-        volume_summary = ""
-        if volume_data:
-            volume_summary = "\n# 📊 今日成交量前20名（真實市場行動，分析必須以此為主軸）\n"
-            volume_summary += "⚠️ 警示：這才是今日市場『最有共識』的實際行動。外資買超金額≠成交量。\n"
-            for s in volume_data[:20]:
-                volume_summary += f"- 第{s['rank']}名: {s['id']} {s['name']} | 成交量 {s['volume']:,} 股 | 收盤 {s.get('close_price', 'N/A')} | 漲跌 {s.get('pct_change', 0):+.2f}%\n"
-
-        # === Historical Comparison ===
-        hist_section = ""
-        if prev_report_path:
-            try:
-                with open(prev_report_path, "r", encoding="utf-8") as f:
-                    prev_content = f.read()
-                hist_section = f"\n# 前日報告（供昨日預測驗收用）\n{prev_content[:3000]}\n"
-            except Exception:
-                hist_section = ""
-            
-        # 廣告插播：僅周四放送
-        is_thursday = datetime.datetime.now().weekday() == 3  # 0=Mon, 3=Thu
-        if is_thursday:
-            ad_instruction = "           - 範例語氣：「插播一下！如果你覺得每天這個客製化的 AI 財經報告對你有幫助，這套系統現在開放免費測試中！**免費試用連結已經放在說明欄**，另外提醒，這個網站功能還在 Beta 階段，分析結果僅供參考，不構成投資建議喔！好，我們回到個股新聞...」"
-        else:
-            ad_instruction = "           - 今日非週四，請「完全略過」此廳播段落，不要在報告中出現任何廣告詞外內容。"
-        # === Dynamic Stock Database (Lazy Loading) ===
-        # Extract active tickers from today's data to avoid bloating the prompt
-        active_tickers = set()
-        
-        # from market_data keys e.g. "2330.TW"
-        for symbol in market_data.keys():
-            active_tickers.add(symbol.replace('.TW', '').replace('.TWO', ''))
-            
-        # from volume_data
-        if volume_data:
-            for s in volume_data:
-                active_tickers.add(str(s['id']))
-                
-        # from institutional_data
-        if institutional_data:
-            for s in institutional_data.get('top_buy', []):
-                active_tickers.add(str(s['id']))
-            for s in institutional_data.get('top_sell', []):
-                active_tickers.add(str(s['id']))
-                
-        stock_db_str = ""
-        if self.stock_db:
-            appended_count = 0
-            for sid, info in self.stock_db.items():
-                if sid in active_tickers:
-                    stock_db_str += f"- {sid} {info.get('name', '')}：分類為「{info.get('sector', '')}」\n"
-                    stock_db_str += f"  └→ 角色：{info.get('supply_chain_role', '')}\n"
-                    not_class = "、".join(info.get('not_classify_as', []))
-                    if not_class:
-                        stock_db_str += f"  🚫 絕對禁止分類為：{not_class}\n"
-                    appended_count += 1
-            if appended_count == 0:
-                stock_db_str = "（今日主力個股尚無特殊之自訂分類，請依常理判斷）"
-        else:
-            stock_db_str = "（目前資料庫為空，請依常理判斷）"
-            
-        # === Second Brain: Historical Knowledge Wiki ===
-        wiki_str = ""
-        wiki_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "knowledge_wiki")
-        if os.path.exists(wiki_dir):
-            for filename in os.listdir(wiki_dir):
-                if filename.endswith(".md"):
-                    try:
-                        with open(os.path.join(wiki_dir, filename), "r", encoding="utf-8") as f:
-                            wiki_str += f"\n=== {filename} ===\n{f.read()}\n"
-                    except Exception as e:
-                        print(f"  [Warning] 無法讀取 Wiki 檔案 {filename}: {e}")
-        if not wiki_str.strip():
-            wiki_str = "（尚未累積任何歷史知識）"
-
-        prompt = f"""
+        tmp_paths = []
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_emb = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy.tmp")
+            tmp_paths.append(tmp_emb)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, self.embeddings)
+            fd, tmp_entries = tempfile.mkstemp(dir=self.cache_dir, suffix=".jsonl.tmp")
+            tmp_paths.append(tmp_entries)
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"".join(_json_line(e) for e in self.entries))
+            os.replace(tmp_emb, self.emb_path)
+            os.replace(tmp_entries, self.entries_path)
+        except (OSError, ValueError) as e:
+            print(f"  [Warning] 無法寫入語意快取: {e}")
+        finally:
+            # Already-replaced temp files are gone; anything left is from a failed write
+            for path in tmp_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+# Daily TW report prompt; filled with str.format_map in MarketAnalyzer.generate_report
+_DAILY_REPORT_TMPL = """
 你是一個台股財金節目的「首席偵探型分析師」。
 你的工作不是寫報告。是找到今天「最讓人意外的數據現象」，然後用說故事的方式把它說得讓人無法跳過。
 
@@ -192,7 +233,7 @@ class MarketAnalyzer:
 ================================================================
 
 ## 今日成交量前20名（市場真實行動，最重要的數據）
-{volume_summary if volume_summary else '（成交量數據未能取得，改以外資買超數據為輔）'}
+{volume_summary}
 
 ## 個股技術指標（含均線與量增比）
 {data_summary}
@@ -371,8 +412,369 @@ STEP 6【技術位與商品——簡短補充，不是主角】
 不知道的地方直接說不知道——這比假裝知道更有說服力，也更讓人信任。
         """
 
+class MarketAnalyzer:
+    def __init__(self, api_key, semantic_cache=False):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        # 讀取環境變數，本地端預設可設為 gemini-pro-latest，網站端若未設定則預設使用 gemini-flash-latest
+        self.model_name = os.getenv("GEMINI_MODEL", "gemini-flash-latest")
+        self.model = genai.GenerativeModel(self.model_name)
+        self.stock_db = self._load_stock_db()
+        self.cache_enabled = os.getenv("GEMINI_CACHE") == "1"
+        self.context_cache_enabled = os.getenv("GEMINI_CONTEXT_CACHE") == "1"
+        # Only the batch report scripts opt in; calls must also pass a semantic_namespace
+        self.semantic_cache = SemanticCache() if semantic_cache else None
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "semantic_hits": 0}
+        # sha256(system_instruction) -> (GenerativeModel, expires_at or None)
+        self._instruction_models = {}
+
+    def _load_stock_db(self):
+        db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "stock_db.json")
+        try:
+            with open(db_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[Warning] Could not load stock_db.json: {e}")
+            return {}
+
+
+    def _model_for(self, system_instruction):
+        """
+        Returns a model carrying the given static instructions.
+        With GEMINI_CONTEXT_CACHE=1 the instructions are registered once as a
+        Gemini CachedContent (cheaper, faster prompt prefix) and re-registered
+        when it expires; if that fails, falls back to a plain model and tries
+        again after CONTEXT_CACHE_RETRY_AFTER seconds.
+        """
+        if not system_instruction:
+            return self.model
+
+        key = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+        entry = self._instruction_models.get(key)
+        if entry and (entry[1] is None or time.time() < entry[1]):
+            return entry[0]
+
+        import google.generativeai as genai
+        expires_at = None
+        if self.context_cache_enabled:
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=self.model_name,
+                    system_instruction=system_instruction,
+                    ttl=CONTEXT_CACHE_TTL,
+                )
+                model = genai.GenerativeModel.from_cached_content(cached)
+                # Refresh a minute early so requests never hit an expired cache
+                expires_at = time.time() + CONTEXT_CACHE_TTL.total_seconds() - 60
+                self._instruction_models[key] = (model, expires_at)
+                return model
+            except Exception as e:
+                print(f"  [Info] Gemini 內容快取建立失敗，改用一般模式: {e}")
+                expires_at = time.time() + CONTEXT_CACHE_RETRY_AFTER
+
+        model = genai.GenerativeModel(self.model_name, system_instruction=system_instruction)
+        self._instruction_models[key] = (model, expires_at)
+        return model
+
+    def _cache_path(self, prompt, system_instruction=None):
+        key_src = f"{self.model_name}\n{system_instruction or ''}\n{prompt}"
+        key = hashlib.sha256(key_src.encode("utf-8")).hexdigest()
+        return os.path.join(GEMINI_CACHE_DIR, f"{key}.txt")
+
+    def _read_cached_response(self, prompt, system_instruction=None):
+        """Returns the cached response for this exact prompt if younger than GEMINI_CACHE_TTL."""
+        path = self._cache_path(prompt, system_instruction)
+        try:
+            if time.time() - os.path.getmtime(path) < GEMINI_CACHE_TTL:
+                with open(path, "r", encoding="utf-8") as f:
+                    return f.read()
+        except OSError:
+            pass
+        return None
+
+    def _write_cached_response(self, prompt, text, system_instruction=None):
+        """Writes via a temp file + os.replace so readers never see a partial entry."""
+        try:
+            os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=GEMINI_CACHE_DIR, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, self._cache_path(prompt, system_instruction))
+        except OSError as e:
+            print(f"  [Warning] 無法寫入 Gemini 快取: {e}")
+
+    def _call_gemini_with_retry(self, prompt, max_retries=3, system_instruction=None, max_total_wait=120,
+                                semantic_namespace=None, semantic_exact=None):
+        """
+        Calls Gemini with exponential backoff retry on 429/5xx errors.
+        Waits are fully jittered (uniform over 0..10s, 20s, 40s, capped at 60s) unless
+        the error carries a server retry delay, and never exceed max_total_wait in total.
+        system_instruction carries the static part of the prompt (see _model_for).
+        With GEMINI_CACHE=1, identical prompts within a day are served from disk;
+        if the analyzer was built with semantic_cache=True and a semantic_namespace
+        (e.g. report type + date) is given, near-identical prompts in that
+        namespace are too (see SemanticCache). semantic_exact is the part of the
+        prompt that must match exactly for such a hit (the numeric data blocks),
+        so a rerun after prices or flows changed is never served the old report.
+        """
+        return self._generate(prompt, max_retries, system_instruction, max_total_wait,
+                              semantic_namespace=semantic_namespace, semantic_exact=semantic_exact)
+
+    def _call_gemini_stream(self, prompt, sink_file, return_text=False, max_retries=3, system_instruction=None, max_total_wait=120,
+                            semantic_namespace=None, semantic_exact=None):
+        """
+        Same as _call_gemini_with_retry, but streams the response into sink_file
+        (a seekable text file) as chunks arrive. The full text is only kept in
+        memory when return_text is set or a response cache needs it.
+        On failure the error message is written to sink_file instead.
+        """
+        text = self._generate(prompt, max_retries, system_instruction, max_total_wait,
+                              sink_file=sink_file, keep_text=return_text,
+                              semantic_namespace=semantic_namespace, semantic_exact=semantic_exact)
+        return text if return_text else None
+
+    def _generate(self, prompt, max_retries, system_instruction, max_total_wait, sink_file=None, keep_text=True,
+                  semantic_namespace=None, semantic_exact=None):
+        if self.cache_enabled:
+            cached = self._read_cached_response(prompt, system_instruction)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                if sink_file is not None:
+                    sink_file.write(cached)
+                return cached
+            self.stats["cache_misses"] += 1
+
+        sem_emb = None
+        # Without a namespace (e.g. ad-hoc per-ticker prompts) near matches are never reused:
+        # those prompts share most of their text, so another ticker's answer could be served
+        if self.semantic_cache is not None and semantic_namespace:
+            sem_key = hashlib.sha256("\0".join((
+                self.model_name, semantic_namespace, system_instruction or "", semantic_exact or "",
+            )).encode("utf-8")).hexdigest()
+            try:
+                sem_emb = self.semantic_cache.embed(prompt)
+                cached = self.semantic_cache.lookup(sem_emb, sem_key)
+                if cached is not None:
+                    self.stats["semantic_hits"] += 1
+                    if sink_file is not None:
+                        sink_file.write(cached)
+                    return cached
+            except Exception as e:
+                print(f"  [Info] 語意快取查詢失敗，略過: {e}")
+                sem_emb = None
+
+        model = self._model_for(system_instruction)
+        total_wait = 0.0
+        keep_text = keep_text or self.cache_enabled or sem_emb is not None
+        sink_start = sink_file.tell() if sink_file is not None else None
+        
+        for attempt in range(max_retries + 1):
+            try:
+                if sink_file is None:
+                    text = model.generate_content(prompt).text
+                else:
+                    # Drop whatever a failed earlier attempt managed to stream
+                    sink_file.seek(sink_start)
+                    sink_file.truncate()
+                    parts = [] if keep_text else None
+                    for chunk in model.generate_content(prompt, stream=True):
+                        sink_file.write(chunk.text)
+                        if keep_text:
+                            parts.append(chunk.text)
+                    text = "".join(parts) if keep_text else None
+                if self.cache_enabled:
+                    self._write_cached_response(prompt, text, system_instruction)
+                if sem_emb is not None:
+                    self.semantic_cache.add(sem_emb, sem_key, prompt, text)
+                return text
+            except Exception as e:
+                retryable_exceptions = _retryable_exceptions()
+                is_retryable = isinstance(e, retryable_exceptions)
+                if not is_retryable and not retryable_exceptions:
+                    # google.api_core unavailable: fall back to matching the status code
+                    error_str = str(e)
+                    is_retryable = "429" in error_str or "500" in error_str or "503" in error_str
+
+                budget = max_total_wait - total_wait
+                hint = _retry_hint_seconds(e) if is_retryable else None
+                if hint is not None:
+                    # Honour the server's delay; retrying earlier would just be rejected again
+                    wait = hint
+                else:
+                    wait = min(random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BASE_WAIT * 2 ** attempt)), budget)
+                
+                if is_retryable and attempt < max_retries and wait <= budget:
+                    print(f"  [Retry] Gemini API 錯誤 (嘗試 {attempt + 1}/{max_retries})，等待 {wait:.1f} 秒後重試...")
+                    time.sleep(wait)
+                    total_wait += wait
+                else:
+                    error_text = f"Error generating report: {e}"
+                    if sink_file is not None:
+                        sink_file.seek(sink_start)
+                        sink_file.truncate()
+                        sink_file.write(error_text)
+                    return error_text
+
+    def generate_report(self, market_data, news_data, institutional_data=None, prev_report_path=None, commodity_data=None, macro_events=None, tech_catalyst_events=None, volume_data=None):
+        """
+        Generates a Markdown report using Gemini with enhanced data.
+        """
+        date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+        
+        # === Stock Data Summary ===
+        parts = []
+        for symbol, data in market_data.items():
+            if data:
+                parts.append(f"- {symbol}: 價格 {data['price']}, 漲跌 {data['change']} ({data['pct_change']}%), 成交量 {data['volume']} (5日均量 {data.get('avg_vol_5d', 'N/A')}, 量增比 {data.get('vol_ratio', 'N/A')}x)")
+                if data.get('ma5'):
+                    parts.append(f", MA5={data['ma5']}")
+                if data.get('ma20'):
+                    parts.append(f", MA20={data['ma20']}")
+                if data.get('rsi') is not None:
+                    parts.append(f", RSI={data['rsi']}")
+                parts.append("\n")
+            else:
+                parts.append(f"- {symbol}: 數據無法取得\n")
+        data_summary = "".join(parts)
+                
+        # === News Summary ===
+        news_summary = "".join(f"- {item['title']} ({item['url']})\n" for item in news_data)
+            
+        # === Institutional Data Summary (with dollar amounts) ===
+        inst_summary = ""
+        if institutional_data and (institutional_data.get("top_buy") or institutional_data.get("top_sell")):
+            data_date = institutional_data.get("data_date", "未知")
+            parts = [f"\n# 三大法人買賣超（依金額排序 - 資料日期：{data_date}）\n"]
+            for heading, key in (("\n## 外資買超前10名（依估計金額排序）\n", "top_buy"),
+                                 ("\n## 外資賣超前10名（依估計金額排序）\n", "top_sell")):
+                parts.append(heading)
+                for s in institutional_data.get(key, []):
+                    amt = s.get('est_amount', 0)
+                    amt_str = f", 估計金額 {amt:+.1f}億" if amt else ""
+                    parts.append(f"- {s['id']} {s['name']}: 外資 {s['foreign_net']:+,}股, 投信 {s['trust_net']:+,}股, 合計 {s['total_net']:+,}股{amt_str}\n")
+            inst_summary = "".join(parts)
+        
+        # === Commodity Data ===
+        commodity_summary = ""
+        if commodity_data:
+            commodity_summary = "\n# 國際商品行情\n"
+            for sym, cdata in commodity_data.items():
+                commodity_summary += f"- {cdata['name']}: ${cdata['price']} ({cdata['pct_change']:+.2f}%)\n"
+        
+        # === Macro Events ===
+        macro_summary = ""
+        if macro_events:
+            macro_summary = "\n# 近期全球重要總經事件與財曆 (Macro Calendar)\n"
+            for item in macro_events:
+                macro_summary += f"- {item['title']} ({item['url']})\n"
+                
+        # === Tech Catalyst Events ===
+        catalyst_summary = ""
+        if tech_catalyst_events:
+            catalyst_summary = "\n# 重大科技/總經催化劍事件（趁近 14 天）\n"
+            for ev in tech_catalyst_events:
+                catalyst_summary += f"- {ev['event']}\n  └→ {ev['snippet']}\n"
+
+        # === Volume Ranking Data (今日成交量排名 - 真實市場投票) ===
+        volume_summary = ""
+        if volume_data:
+            parts = [
+                "\n# 📊 今日成交量前20名（真實市場行動，分析必須以此為主軸）\n",
+                "⚠️ 警示：這才是今日市場『最有共識』的實際行動。外資買超金額≠成交量。\n",
+            ]
+            for s in volume_data[:20]:
+                parts.append(f"- 第{s['rank']}名: {s['id']} {s['name']} | 成交量 {s['volume']:,} 股 | 收盤 {s.get('close_price', 'N/A')} | 漲跌 {s.get('pct_change', 0):+.2f}%\n")
+            volume_summary = "".join(parts)
+
+        # === Historical Comparison ===
+        hist_section = ""
+        if prev_report_path:
+            try:
+                with open(prev_report_path, "r", encoding="utf-8") as f:
+                    prev_content = f.read(3000)  # only the head goes into the prompt
+                hist_section = f"\n# 前日報告（供昨日預測驗收用）\n{prev_content}\n"
+            except Exception:
+                hist_section = ""
+            
+        # 廣告插播：僅周四放送
+        is_thursday = datetime.datetime.now().weekday() == 3  # 0=Mon, 3=Thu
+        if is_thursday:
+            ad_instruction = "           - 範例語氣：「插播一下！如果你覺得每天這個客製化的 AI 財經報告對你有幫助，這套系統現在開放免費測試中！**免費試用連結已經放在說明欄**，另外提醒，這個網站功能還在 Beta 階段，分析結果僅供參考，不構成投資建議喔！好，我們回到個股新聞...」"
+        else:
+            ad_instruction = "           - 今日非週四，請「完全略過」此廳播段落，不要在報告中出現任何廣告詞外內容。"
+        # === Dynamic Stock Database (Lazy Loading) ===
+        # Extract active tickers from today's data to avoid bloating the prompt
+        active_tickers = set()
+        
+        # from market_data keys e.g. "2330.TW"
+        for symbol in market_data.keys():
+            active_tickers.add(symbol.replace('.TW', '').replace('.TWO', ''))
+            
+        # from volume_data
+        if volume_data:
+            for s in volume_data:
+                active_tickers.add(str(s['id']))
+                
+        # from institutional_data
+        if institutional_data:
+            for s in institutional_data.get('top_buy', []):
+                active_tickers.add(str(s['id']))
+            for s in institutional_data.get('top_sell', []):
+                active_tickers.add(str(s['id']))
+                
+        stock_db_str = ""
+        if self.stock_db:
+            appended_count = 0
+            parts = []
+            for sid, info in self.stock_db.items():
+                if sid in active_tickers:
+                    parts.append(f"- {sid} {info.get('name', '')}：分類為「{info.get('sector', '')}」\n")
+                    parts.append(f"  └→ 角色：{info.get('supply_chain_role', '')}\n")
+                    not_class = "、".join(info.get('not_classify_as', []))
+                    if not_class:
+                        parts.append(f"  🚫 絕對禁止分類為：{not_class}\n")
+                    appended_count += 1
+            stock_db_str = "".join(parts)
+            if appended_count == 0:
+                stock_db_str = "（今日主力個股尚無特殊之自訂分類，請依常理判斷）"
+        else:
+            stock_db_str = "（目前資料庫為空，請依常理判斷）"
+            
+        # === Second Brain: Historical Knowledge Wiki ===
+        parts = []
+        wiki_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "knowledge_wiki")
+        if os.path.exists(wiki_dir):
+            for filename in os.listdir(wiki_dir):
+                if filename.endswith(".md"):
+                    try:
+                        with open(os.path.join(wiki_dir, filename), "r", encoding="utf-8") as f:
+                            parts.append(f"\n=== {filename} ===\n{f.read()}\n")
+                    except Exception as e:
+                        print(f"  [Warning] 無法讀取 Wiki 檔案 {filename}: {e}")
+        wiki_str = "".join(parts)
+        if not wiki_str.strip():
+            wiki_str = "（尚未累積任何歷史知識）"
+
+        prompt = _DAILY_REPORT_TMPL.format_map({
+            "date_str": date_str,
+            "volume_summary": volume_summary or "（成交量數據未能取得，改以外資買超數據為輔）",
+            "data_summary": data_summary,
+            "inst_summary": inst_summary,
+            "commodity_summary": commodity_summary,
+            "news_summary": news_summary,
+            "catalyst_summary": catalyst_summary,
+            "hist_section": hist_section,
+            "wiki_str": wiki_str,
+            "stock_db_str": stock_db_str,
+            "ad_instruction": ad_instruction,
+        })
+
 
-        return self._call_gemini_with_retry(prompt)
+        return self._call_gemini_with_retry(
+            prompt,
+            semantic_namespace=f"tw_daily:{date_str}",
+            semantic_exact="\n".join((data_summary, inst_summary, commodity_summary, volume_summary or "")),
+        )
 
 
     def generate_weekend_special_report(self, market_data, news_data, commodity_data=None, macro_events=None):
@@ -449,4 +851,8 @@ STEP 6【技術位與商品——簡短補充，不是主角】
         Please generate the comprehensive Traditional Chinese Markdown report now.
         """
         
-        return self._call_gemini_with_retry(prompt)
+        return self._call_gemini_with_retry(
+            prompt,
+            semantic_namespace=f"weekend_special:{date_str}",
+            semantic_exact="\n".join((data_summary, commodity_summary)),
+        )
@@ -1,28 +1,273 @@
-import yfinance as yf
-from tavily import TavilyClient
+import os
 import datetime
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+from modules._indicators import _wilder_rsi
+
+try:
+    import requests_cache  # optional: persists TWSE responses across runs
+except ImportError:
+    requests_cache = None
+
+try:
+    import orjson  # optional: faster decoding of the ~1000-row T86 payload
+except ImportError:
+    orjson = None
+
+# T86 tables only change once per trading day; share them for 10 minutes
+T86_CACHE_TTL = 600
+# After a failed walk, callers get None for this long instead of re-walking back to back
+T86_FAILURE_TTL = 60
+
+# On-disk TWSE response cache (requests-cache, listed in requirements.txt; skipped if missing)
+HTTP_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "twse")
+HTTP_CACHE_EXPIRE = 6 * 60 * 60
+
+# The T86 day-walk requests this many of the most recent weekdays at once
+T86_RACE_DAYS = 2
+# TWSE throttles IPs above ~3 requests / 5 s, so the speculative (older-day) probes
+# make a single short attempt; if one fails it is redone serially with full retries
+T86_PROBE_TIMEOUT = 8
+
+# Keep-alive pool for www.twse.com.tw: room for the T86 race plus a concurrent
+# single-stock or institutional fetch from the web app. The adapter keeps its
+# default of no retries; our own day-walk loops retry and catch ReadTimeout.
+TWSE_POOL_SIZE = 4
+
+# Price history is reused within a run (e.g. daily + weekly view of one symbol).
+# The fetcher is shared by the long-running web app, so the memo is an LRU.
+HISTORY_MEMO_TTL = 300
+HISTORY_MEMO_SIZE = 128
+
+# Per-symbol Yahoo fetches are I/O bound; overlap up to this many in get_many
+GET_MANY_MAX_WORKERS = 16
+
+# News items are pasted into prompts: cap titles and drop tracking parameters
+MAX_NEWS_TITLE_LEN = 120
+TRACKING_PARAM_PREFIXES = ("utm_", "gclid=", "fbclid=")
+
+
+def clean_url(url):
+    """Removes utm_*/gclid/fbclid query parameters from a URL."""
+    parts = urllib.parse.urlsplit(url)
+    if not parts.query:
+        return url
+    query = "&".join(kv for kv in parts.query.split("&") if not kv.startswith(TRACKING_PARAM_PREFIXES))
+    return urllib.parse.urlunsplit(parts._replace(query=query))
+
+
+def news_url_key(url):
+    """
+    Dedup key for news links: lowercased host + path + query without tracking
+    parameters. The fragment is ignored; the rest of the query is kept since
+    some sites identify articles by it (e.g. ?id=).
+    """
+    parts = urllib.parse.urlsplit(clean_url(url))
+    key = parts.netloc.lower() + parts.path.rstrip("/")
+    return f"{key}?{parts.query}" if parts.query else key
+
+
+def _top_n_indices(values, n):
+    """
+    Indices of the n largest entries of `values`, largest first, in O(M).
+    Ties are resolved in input order, so the result matches
+    sorted(range(M), key=values.__getitem__, reverse=True)[:n].
+    """
+    m = len(values)
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+    if n >= m:
+        return np.argsort(-values, kind="stable")
+    # n-th largest value; everything strictly above it is in, ties fill the rest
+    kth = np.partition(values, m - n)[m - n]
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[:n - len(above)]
+    idx = np.concatenate((above, ties))
+    return idx[np.argsort(-values[idx], kind="stable")]
+
+
+def _parse_t86_rows(rows):
+    """
+    Parses TWSE T86 rows into a DataFrame with columns
+    id/name/foreign_net/trust_net/total_net. Rows with unparsable
+    numbers are dropped.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(rows)
+    if df.empty or df.shape[1] <= 10:
+        return pd.DataFrame(columns=["id", "name", "foreign_net", "trust_net", "total_net"])
+    out = pd.DataFrame({
+        "id": df[0].str.strip(),
+        "name": df[1].str.strip(),
+    })
+    # total_net is each row's own last cell: rows can be shorter than the widest one
+    last_cells = pd.Series([row[-1] if row else None for row in rows], index=df.index, dtype=object)
+    for name, cells in (("foreign_net", df[4]), ("trust_net", df[10]), ("total_net", last_cells)):
+        text = cells.str.replace(",", "", regex=False).str.replace(" ", "", regex=False)
+        # Integers only, as int() required: "1.5" or "--" must drop the row, not truncate
+        out[name] = pd.to_numeric(text.where(text.str.fullmatch(r"[+-]?\d+", na=False)), errors="coerce")
+    out = out.dropna(subset=["id", "name", "foreign_net", "trust_net", "total_net"])
+    return out.astype({"foreign_net": np.int64, "trust_net": np.int64, "total_net": np.int64})
+
+
+def _response_json(response):
+    """response.json(), decoded with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+_TWSE_STAT_OK_RE = re.compile(rb'"stat"\s*:\s*"OK"')
+
+
+def _twse_response_ok(response):
+    """
+    Only cache TWSE answers that carry data; "no data yet" replies must be refetched.
+    A byte scan rather than a JSON decode: the caller decodes the payload anyway.
+    """
+    return _TWSE_STAT_OK_RE.search(response.content) is not None
+
+
+def _make_twse_session():
+    session = None
+    if requests_cache is not None:
+        try:
+            os.makedirs(os.path.dirname(HTTP_CACHE_PATH), exist_ok=True)
+            session = requests_cache.CachedSession(
+                HTTP_CACHE_PATH,
+                expire_after=HTTP_CACHE_EXPIRE,
+                allowable_codes=(200,),
+                filter_fn=_twse_response_ok,
+            )
+        except Exception as e:
+            print(f"[Warning] 無法建立 HTTP 快取，改用一般連線: {e}")
+    if session is None:
+        session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=TWSE_POOL_SIZE, pool_maxsize=TWSE_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    return session
+
 
 class DataFetcher:
     def __init__(self, tavily_api_key):
-        self.tavily_client = TavilyClient(api_key=tavily_api_key)
+        # yfinance/tavily/pandas are imported on first use: TWSE-only callers skip their import cost
+        self._tavily_api_key = tavily_api_key
+        self._tavily_client = None
+        self._t86_cache = {"ts": 0, "data": None}
+        self._t86_failed_at = 0
+        # Future of the fetch currently in progress; concurrent callers wait on it
+        self._t86_inflight = None
+        self._t86_lock = threading.Lock()
+        # One keep-alive session for all TWSE calls so TCP/TLS setup is paid once
+        self.session = _make_twse_session()
+        self._history_memo = OrderedDict()
+        self._history_lock = threading.Lock()
+        self._tickers = OrderedDict()
+
+    @property
+    def tavily_client(self):
+        if self._tavily_client is None:
+            from tavily import TavilyClient
+            self._tavily_client = TavilyClient(api_key=self._tavily_api_key)
+        return self._tavily_client
+
+    def _ticker(self, symbol):
+        """
+        Returns a yf.Ticker for `symbol`, reused across calls. Each Ticker keeps
+        its own cached data, so this is an LRU bounded like _history_memo.
+        """
+        with self._history_lock:
+            ticker = self._tickers.get(symbol)
+            if ticker is None:
+                import yfinance as yf
+                ticker = yf.Ticker(symbol)
+                self._tickers[symbol] = ticker
+                while len(self._tickers) > HISTORY_MEMO_SIZE:
+                    self._tickers.popitem(last=False)
+            self._tickers.move_to_end(symbol)
+            return ticker
+
+    def _history(self, symbol, period):
+        """
+        self._ticker(symbol).history(period=...), memoised for HISTORY_MEMO_TTL
+        seconds in an LRU of at most HISTORY_MEMO_SIZE entries.
+        Entries are [fetched_at, hist, snapshot]; see _history_snapshot.
+        """
+        key = (symbol, period)
+        now = time.time()
+        with self._history_lock:
+            entry = self._history_memo.get(key)
+            if entry:
+                if now - entry[0] < HISTORY_MEMO_TTL:
+                    self._history_memo.move_to_end(key)
+                    return entry[1]
+                del self._history_memo[key]
+        hist = self._ticker(symbol).history(period=period)
+        if not hist.empty:
+            with self._history_lock:
+                self._history_memo[key] = [now, hist, None]
+                self._history_memo.move_to_end(key)
+                while len(self._history_memo) > HISTORY_MEMO_SIZE:
+                    self._history_memo.popitem(last=False)
+        return hist
+
+    def _snapshot(self, closes):
+        """
+        Returns (MA5, MA20, RSI) for a close-price array in one go, with a single
+        np.diff shared by the RSI; None where history is too short.
+        """
+        closes = np.asarray(closes, dtype=np.float64)
+        n = len(closes)
+        ma5 = round(float(closes[-5:].mean()), 2) if n >= 5 else None
+        ma20 = round(float(closes[-20:].mean()), 2) if n >= 20 else None
+        rsi = self._calc_rsi_from_deltas(np.diff(closes)) if n >= 15 else None
+        return ma5, ma20, rsi
+
+    def _history_snapshot(self, symbol, period, hist, closes):
+        """
+        _snapshot(closes) for a frame returned by _history(symbol, period).
+        The result is kept on that frame's _history_memo entry, tagged with
+        (last-bar date, row count), so get_stock_data and get_weekly_stock_data
+        share it and it is evicted or refreshed together with the history.
+        """
+        key = (symbol, period)
+        tag = (hist.index[-1], len(hist))
+        with self._history_lock:
+            entry = self._history_memo.get(key)
+            if entry is not None and entry[2] is not None and entry[2][0] == tag:
+                return entry[2][1]
+        snapshot = self._snapshot(closes)
+        with self._history_lock:
+            entry = self._history_memo.get(key)
+            if entry is not None and entry[1] is hist:
+                entry[2] = (tag, snapshot)
+        return snapshot
 
     def _calc_rsi(self, closes, period=14):
         """Calculate RSI (Relative Strength Index)."""
-        deltas = np.diff(closes)
-        gains = np.where(deltas > 0, deltas, 0)
-        losses = np.where(deltas < 0, -deltas, 0)
+        return self._calc_rsi_from_deltas(np.diff(np.asarray(closes, dtype=np.float64)), period)
+
+    def _calc_rsi_from_deltas(self, deltas, period=14):
+        """RSI from precomputed day-over-day close differences."""
+        # fmax (not maximum) so a NaN close counts as no move, as np.where did
+        gains = np.fmax(deltas, 0.0)
+        losses = np.fmax(-deltas, 0.0)
         
         if len(gains) < period:
             return None
             
-        avg_gain = np.mean(gains[:period])
-        avg_loss = np.mean(losses[:period])
-        
-        for i in range(period, len(gains)):
-            avg_gain = (avg_gain * (period - 1) + gains[i]) / period
-            avg_loss = (avg_loss * (period - 1) + losses[i]) / period
+        # Wilder smoothing runs in a compiled kernel (see modules/_indicators.py)
+        avg_gain, avg_loss = _wilder_rsi(gains, losses, period)
             
         if avg_loss == 0:
             return 100.0
@@ -35,26 +280,24 @@ class DataFetcher:
         Returns price, change, volume, MA5, MA20, RSI.
         """
         try:
-            ticker = yf.Ticker(symbol)
-            hist = ticker.history(period="60d")
+            hist = self._history(symbol, "60d")
             
             if hist.empty or len(hist) < 2:
                 print(f"[Warning] 無法取得 {symbol} 的數據")
                 return None
                 
-            closes = hist['Close'].values
+            # Zero-copy views of the frame's float64 columns (prices keep full precision)
+            closes = hist['Close'].to_numpy(dtype=np.float64, copy=False)
             current_close = closes[-1]
             prev_close = closes[-2]
             change = current_close - prev_close
             pct_change = (change / prev_close) * 100
             
             # Technical Indicators
-            ma5 = round(float(np.mean(closes[-5:])), 2) if len(closes) >= 5 else None
-            ma20 = round(float(np.mean(closes[-20:])), 2) if len(closes) >= 20 else None
-            rsi = self._calc_rsi(closes) if len(closes) >= 15 else None
+            ma5, ma20, rsi = self._history_snapshot(symbol, "60d", hist, closes)
             
             # Volume Profile Analysis
-            volumes = hist['Volume'].values
+            volumes = hist['Volume'].to_numpy(copy=False)
             avg_vol_5d = int(np.mean(volumes[-5:])) if len(volumes) >= 5 else int(volumes[-1])
             vol_ratio = round(float(volumes[-1] / avg_vol_5d), 2) if avg_vol_5d > 0 else 1.0
             
@@ -77,6 +320,20 @@ class DataFetcher:
             print(f"[Error] 取得 {symbol} 數據失敗: {e}")
             return None
 
+    def get_many(self, symbols, weekly=False, max_workers=GET_MANY_MAX_WORKERS):
+        """
+        Fetches get_stock_data (or get_weekly_stock_data if weekly) for every
+        symbol concurrently. Returns {symbol: data or None} in input order;
+        each fetch keeps its own error handling, so one failure doesn't
+        affect the rest.
+        """
+        symbols = list(symbols)
+        if not symbols:
+            return {}
+        fn = self.get_weekly_stock_data if weekly else self.get_stock_data
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(symbols))) as executor:
+            return dict(zip(symbols, executor.map(fn, symbols)))
+
     def get_commodity_data(self):
         """
         Fetches Gold, Oil, Silver prices via yfinance.
@@ -90,9 +347,8 @@ class DataFetcher:
         results = {}
         for symbol, name in commodities.items():
             try:
-                ticker = yf.Ticker(symbol)
                 # Just fetch the last 2 days to get the exact 1-day change
-                hist = ticker.history(period="2d")
+                hist = self._history(symbol, "2d")
                 if hist.empty or len(hist) < 2:
                     continue
                 current = float(hist['Close'].iloc[-1])
@@ -130,8 +386,7 @@ class DataFetcher:
         plus current technical indicators (MA5, MA20, RSI).
         """
         try:
-            ticker = yf.Ticker(symbol)
-            hist = ticker.history(period="60d")
+            hist = self._history(symbol, "60d")
 
             if hist.empty or len(hist) < trading_days + 1:
                 print(f"[Warning] 無法取得 {symbol} 的週數據")
@@ -139,11 +394,12 @@ class DataFetcher:
 
             # Last N trading days for the week
             week_data = hist.tail(trading_days)
-            closes = hist['Close'].values
-            week_closes = week_data['Close'].values
-            week_highs = week_data['High'].values
-            week_lows = week_data['Low'].values
-            week_volumes = week_data['Volume'].values
+            # Zero-copy views; the week is just the tail of the full-history arrays
+            closes = hist['Close'].to_numpy(dtype=np.float64, copy=False)
+            week_closes = closes[-trading_days:]
+            week_highs = week_data['High'].to_numpy(copy=False)
+            week_lows = week_data['Low'].to_numpy(copy=False)
+            week_volumes = week_data['Volume'].to_numpy(copy=False)
 
             # The close before the week started (for weekly change calc)
             pre_week_close = hist['Close'].iloc[-(trading_days + 1)]
@@ -157,23 +413,22 @@ class DataFetcher:
             avg_volume = int(np.mean(week_volumes))
 
             # Technical indicators (current)
-            ma5 = round(float(np.mean(closes[-5:])), 2) if len(closes) >= 5 else None
-            ma20 = round(float(np.mean(closes[-20:])), 2) if len(closes) >= 20 else None
-            rsi = self._calc_rsi(closes) if len(closes) >= 15 else None
+            ma5, ma20, rsi = self._history_snapshot(symbol, "60d", hist, closes)
 
-            # Daily series for narration
+            # Daily series for narration (hist has > trading_days rows, so every day has a previous close)
+            dates = week_data.index.strftime("%m/%d").tolist()
+            prev_closes = closes[-(trading_days + 1):-1]
             daily_series = []
-            for idx, row in week_data.iterrows():
-                date_str = idx.strftime("%m/%d")
-                day_close = round(float(row['Close']), 2)
-                day_change = round(float(row['Close'] - (hist['Close'].shift(1).loc[idx] if idx in hist.index else row['Open'])), 2)
+            for date_str, close, prev, vol in zip(dates, week_closes, prev_closes, week_volumes):
+                day_close = round(float(close), 2)
+                day_change = round(float(close - prev), 2)
                 day_pct = round((day_change / (day_close - day_change)) * 100, 2) if (day_close - day_change) != 0 else 0
                 daily_series.append({
                     "date": date_str,
                     "close": day_close,
                     "change": day_change,
                     "pct_change": day_pct,
-                    "volume": int(row['Volume']),
+                    "volume": int(vol),
                 })
 
             return {
@@ -201,118 +456,61 @@ class DataFetcher:
         """
         print("正在獲取三大法人買賣超數據...")
 
-        data = None
-        data_date_str = None
-
         try:
-            # Try today first, then fall back up to 14 days (covers CNY and other long holidays)
-            for days_back in range(0, 15):
-                check_date = datetime.datetime.now() - datetime.timedelta(days=days_back)
-                # Skip weekends
-                if check_date.weekday() >= 5:
-                    continue
-
-                date_str = check_date.strftime("%Y%m%d")
-                url = f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date_str}&selectType=ALLBUT0999&response=json"
-
-                try:
-                    import time
-                    for attempt in range(3): # Retry up to 3 times for timeout
-                        try:
-                            # Increase timeout to 30 seconds since TWSE is very slow post-market
-                            resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=30)
-                            break
-                        except requests.exceptions.SSLError:
-                            if days_back == 0 and attempt == 0:
-                                print("  [Info] SSL 驗證失敗，嘗試跳過驗證...")
-                            resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=30, verify=False)
-                            break
-                        except requests.exceptions.ReadTimeout:
-                            if attempt < 2:
-                                print(f"  [Warning] TWSE API 讀取超時，重試第 {attempt+1} 次...")
-                                time.sleep(2)
-                                continue
-                            else:
-                                raise
-                        except Exception as e:
-                            raise e
-
-                    result = resp.json()
-                    if result.get("stat") == "OK" and "data" in result:
-                        data = result
-                        data_date_str = check_date.strftime("%Y-%m-%d")
-                        if days_back > 0:
-                            print(f"  [Info] 使用 {data_date_str} 的法人數據（最近有資料的交易日）")
-                        break
-                    else:
-                        if days_back == 0:
-                            print(f"  [Info] 今日數據尚未發布，往前搜尋中...")
-                        
-                except Exception as e:
-                    if days_back == 0:
-                        print(f"  [Info] 取得今日法人數據發生錯誤 ({e})，往前搜尋中...")
-                    continue
-
+            # Try today first, then fall back up to 14 days (covers CNY and other long holidays).
+            # Timeout is 30 seconds since TWSE is very slow post-market.
+            data, days_back, check_date = self._probe_t86(timeout=30, retry_wait=2, verbose=True)
             if data is None:
                 print("  [Warning] 無法取得三大法人數據（已搜尋近 14 天）")
                 return {"top_buy": [], "top_sell": [], "data_date": None}
 
-            def parse_num(s):
-                return int(s.replace(",", "").replace(" ", ""))
+            data_date_str = check_date.strftime("%Y-%m-%d")
+            if days_back > 0:
+                print(f"  [Info] 使用 {data_date_str} 的法人數據（最近有資料的交易日）")
 
-            all_stocks = []
-            for row in data["data"]:
-                try:
-                    stock_id = row[0].strip()
-                    stock_name = row[1].strip()
-                    foreign_net = parse_num(row[4])
-                    trust_net = parse_num(row[10])
-                    total_net = parse_num(row[-1])
-
-                    all_stocks.append({
-                        "id": stock_id,
-                        "name": stock_name,
-                        "foreign_net": foreign_net,
-                        "trust_net": trust_net,
-                        "total_net": total_net,
-                    })
-                except (ValueError, IndexError):
-                    continue
+            df = _parse_t86_rows(data["data"])
+            ids = df["id"].tolist()
+            names = df["name"].tolist()
+            foreign_nets = df["foreign_net"].to_numpy()
+            trust_nets = df["trust_net"].to_numpy()
+            total_nets = df["total_net"].to_numpy()
 
             # Fetch close prices for top movers to compute dollar amounts
             print("  正在計算法人買賣超金額...")
-            # Get unique stock IDs that need price lookup (top candidates)
-            sorted_by_shares = sorted(all_stocks, key=lambda x: abs(x["foreign_net"]), reverse=True)
-            price_candidates = sorted_by_shares[:top_n * 4]  # Look up more than needed
-            
-            for stock in price_candidates:
+            # Only the top candidates by share count get a price lookup; the rest stay at 0
+            amounts = np.zeros(len(df), dtype=np.float64)
+            close_prices = {}
+            for i in _top_n_indices(np.abs(foreign_nets), top_n * 4):  # Look up more than needed
                 try:
-                    tw_symbol = f"{stock['id']}.TW"
-                    tk = yf.Ticker(tw_symbol)
-                    hist = tk.history(period="5d")
+                    tw_symbol = f"{ids[i]}.TW"
+                    hist = self._history(tw_symbol, "5d")
                     if not hist.empty:
                         close_price = float(hist['Close'].iloc[-1])
-                        stock['close_price'] = close_price
+                        close_prices[i] = close_price
                         # est_amount in TWD (shares * price), convert to 億
-                        stock['est_amount'] = round(stock['foreign_net'] * close_price / 1e8, 2)
+                        amounts[i] = round(int(foreign_nets[i]) * close_price / 1e8, 2)
                     else:
-                        stock['close_price'] = None
-                        stock['est_amount'] = 0
+                        close_prices[i] = None
                 except Exception:
-                    stock['close_price'] = None
-                    stock['est_amount'] = 0
-
-            # Fill 0 for stocks we didn't look up
-            for stock in all_stocks:
-                if 'est_amount' not in stock:
-                    stock['est_amount'] = 0
+                    close_prices[i] = None
+
+            def stock_at(i):
+                stock = {
+                    "id": ids[i],
+                    "name": names[i],
+                    "foreign_net": int(foreign_nets[i]),
+                    "trust_net": int(trust_nets[i]),
+                    "total_net": int(total_nets[i]),
+                }
+                if i in close_prices:
+                    stock["close_price"] = close_prices[i]
+                stock["est_amount"] = float(amounts[i]) if close_prices.get(i) is not None else 0
+                return stock
 
-            # Sort by estimated dollar amount
-            sorted_by_amount = sorted(all_stocks, key=lambda x: x["est_amount"], reverse=True)
-            top_buy = sorted_by_amount[:top_n]
-            # For sells, sort ascending (most negative first)
-            sorted_by_amount_sell = sorted(all_stocks, key=lambda x: x["est_amount"])
-            top_sell = sorted_by_amount_sell[:top_n]
+            # Rank by estimated dollar amount (only the top/bottom N get sorted)
+            top_buy = [stock_at(i) for i in _top_n_indices(amounts, top_n)]
+            # For sells, most negative first
+            top_sell = [stock_at(i) for i in _top_n_indices(-amounts, top_n)]
 
             print(f"  ✅ 外資買超前 {top_n} 名（依金額排序）:")
             for s in top_buy[:5]:
@@ -329,58 +527,160 @@ class DataFetcher:
             print(f"[Error] 取得三大法人數據失敗: {e}")
             return {"top_buy": [], "top_sell": [], "data_date": None}
 
-    def get_single_stock_institutional_data(self, ticker):
+    def _fetch_t86_index(self):
         """
-        Fetches TWSE institutional data and ONLY parses the requested ticker.
-        This is extremely fast because it skips hitting Yahoo Finance 40 times.
+        Fetches the most recent TWSE T86 table and indexes it by stock id.
+        Returns {stock_id: {"foreign_net", "trust_net", "total_net"}}, or None
+        if no trading day in the last 14 days has data.
         """
-        try:
-            for days_back in range(0, 15):
-                check_date = datetime.datetime.now() - datetime.timedelta(days=days_back)
-                if check_date.weekday() >= 5:
-                    continue
+        result, _, _ = self._probe_t86(timeout=15, retry_wait=1)
+        if result is None:
+            return None
+        df = _parse_t86_rows(result["data"])
+        nets = zip(df["foreign_net"].tolist(), df["trust_net"].tolist(), df["total_net"].tolist())
+        return {
+            stock_id: {"foreign_net": f, "trust_net": t, "total_net": tot}
+            for stock_id, (f, t, tot) in zip(df["id"].tolist(), nets)
+        }
 
-                date_str = check_date.strftime("%Y%m%d")
-                url = f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date_str}&selectType=ALLBUT0999&response=json"
+    def _fetch_t86_day(self, check_date, timeout, retry_wait, verbose=False, is_today=False, attempts=3):
+        """
+        Fetches the T86 table for one date, retrying read timeouts up to
+        `attempts` times. Returns the JSON payload if TWSE has data for that
+        day, None otherwise. Network errors propagate.
+        """
+        date_str = check_date.strftime("%Y%m%d")
+        url = f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date_str}&selectType=ALLBUT0999&response=json"
 
-                try:
-                    import time
-                    for attempt in range(3):
-                        try:
-                            resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
-                            break
-                        except requests.exceptions.SSLError:
-                            resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15, verify=False)
-                            break
-                        except requests.exceptions.ReadTimeout:
-                            if attempt < 2:
-                                time.sleep(1)
-                                continue
-                            else:
-                                raise
-
-                    result = resp.json()
-                    if result.get("stat") == "OK" and "data" in result:
-                        
-                        def parse_num(s):
-                            return int(s.replace(",", "").replace(" ", ""))
-
-                        for row in result["data"]:
-                            try:
-                                stock_id = row[0].strip()
-                                if stock_id == ticker:
-                                    foreign_net = parse_num(row[4])
-                                    trust_net = parse_num(row[10])
-                                    total_net = parse_num(row[-1])
-                                    return {"foreign_net": foreign_net, "trust_net": trust_net, "total_net": total_net}
-                            except (ValueError, IndexError):
-                                continue
-                                
-                        # If reached here, TWSE data was fetched but ticker not found (e.g., it's OTC or no institutional action)
-                        return None
-                except Exception:
+        for attempt in range(attempts): # Retry read timeouts
+            try:
+                resp = self.session.get(url, timeout=timeout)
+                break
+            except requests.exceptions.SSLError:
+                if verbose and is_today and attempt == 0:
+                    print("  [Info] SSL 驗證失敗，嘗試跳過驗證...")
+                resp = self.session.get(url, timeout=timeout, verify=False)
+                break
+            except requests.exceptions.ReadTimeout:
+                if attempt < attempts - 1:
+                    if verbose:
+                        print(f"  [Warning] TWSE API 讀取超時，重試第 {attempt+1} 次...")
+                    time.sleep(retry_wait)
                     continue
-            return None
+                else:
+                    raise
+
+        result = _response_json(resp)
+        if result.get("stat") == "OK" and "data" in result:
+            return result
+        return None
+
+    def _probe_t86(self, timeout, retry_wait, verbose=False):
+        """
+        Finds the most recent weekday within 14 days that has T86 data.
+        The newest T86_RACE_DAYS weekdays are requested concurrently and the
+        freshest hit wins; older days are then tried one at a time. Only the
+        newest day gets the full timeout/retries up front, the others are short
+        single-attempt probes so abandoned ones finish quickly.
+        Returns (payload, days_back, check_date), or (None, None, None).
+        """
+        now = datetime.datetime.now()
+        candidates = [
+            (days_back, check_date)
+            for days_back in range(0, 15)
+            # Skip weekends
+            if (check_date := now - datetime.timedelta(days=days_back)).weekday() < 5
+        ]
+
+        probe_failed = object()
+
+        def probe(days_back, check_date):
+            try:
+                return self._fetch_t86_day(check_date, min(timeout, T86_PROBE_TIMEOUT), retry_wait, attempts=1)
+            except Exception:
+                return probe_failed
+
+        def fetch(days_back, check_date):
+            is_today = days_back == 0
+            try:
+                result = self._fetch_t86_day(check_date, timeout, retry_wait, verbose, is_today)
+            except Exception as e:
+                if verbose and is_today:
+                    print(f"  [Info] 取得今日法人數據發生錯誤 ({e})，往前搜尋中...")
+                return None
+            if result is None and verbose and is_today:
+                print(f"  [Info] 今日數據尚未發布，往前搜尋中...")
+            return result
+
+        race, tail = candidates[:T86_RACE_DAYS], candidates[T86_RACE_DAYS:]
+        if race:
+            ex = ThreadPoolExecutor(max_workers=len(race))
+            try:
+                futures = [ex.submit(fetch, *race[0])] + [ex.submit(probe, *c) for c in race[1:]]
+                # Walk newest-first so an older day never beats a fresher one
+                for (days_back, check_date), future in zip(race, futures):
+                    result = future.result()
+                    if result is probe_failed:
+                        result = fetch(days_back, check_date)
+                    if result is not None:
+                        return result, days_back, check_date
+            finally:
+                # Don't wait on the older in-flight probes once we have an answer
+                ex.shutdown(wait=False, cancel_futures=True)
+
+        for days_back, check_date in tail:
+            result = fetch(days_back, check_date)
+            if result is not None:
+                return result, days_back, check_date
+        return None, None, None
+
+    def _get_t86_index_cached(self):
+        """
+        Returns the T86 index from _fetch_t86_index, refetching at most every
+        T86_CACHE_TTL seconds. The network walk runs outside the lock and only
+        once at a time: concurrent callers join the in-flight fetch. A failed
+        fetch returns None and is not retried for T86_FAILURE_TTL seconds.
+        """
+        with self._t86_lock:
+            now = time.time()
+            if self._t86_cache["data"] is not None and now - self._t86_cache["ts"] < T86_CACHE_TTL:
+                return self._t86_cache["data"]
+            if now - self._t86_failed_at < T86_FAILURE_TTL:
+                return None
+            inflight = self._t86_inflight
+            if inflight is None:
+                inflight = self._t86_inflight = Future()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            return inflight.result()
+
+        index = None
+        try:
+            index = self._fetch_t86_index()
+        finally:
+            with self._t86_lock:
+                if index is not None:
+                    self._t86_cache = {"ts": time.time(), "data": index}
+                else:
+                    self._t86_failed_at = time.time()
+                self._t86_inflight = None
+            inflight.set_result(index)
+        return index
+
+    def get_single_stock_institutional_data(self, ticker):
+        """
+        Fetches TWSE institutional data for the requested ticker only.
+        This is extremely fast because it skips hitting Yahoo Finance 40 times.
+        Returns None if the ticker is absent (e.g., it's OTC or no institutional action).
+        """
+        try:
+            index = self._get_t86_index_cached()
+            if index is None:
+                return None
+            return index.get(ticker)
         except Exception as e:
             print(f"[Error] 快速取得單一個股法人數據失敗: {e}")
             return None
@@ -398,7 +698,13 @@ class DataFetcher:
                 print(f"  [Info] 無結果，嘗試更廣泛的關鍵詞: {broad_query}")
                 response = self.tavily_client.search(broad_query, search_depth="advanced", max_results=5, days=days)
             
-            return response.get('results', [])
+            results = response.get('results', [])
+            for item in results:
+                if item.get('url'):
+                    item['url'] = clean_url(item['url'])
+                if item.get('title'):
+                    item['title'] = item['title'][:MAX_NEWS_TITLE_LEN]
+            return results
             
         except Exception as e:
             print(f"[Error] Tavily 搜尋失敗: {e}")
@@ -0,0 +1,91 @@
+"""
+Small filesystem helpers shared by the report scripts.
+"""
+import os
+import gzip
+import datetime
+import functools
+import contextlib
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=8)
+def _scan_reports(directory, prefix, suffix, mtime_ns):
+    # mtime_ns is part of the cache key only: adding/removing a report bumps it
+    with os.scandir(directory) as it:
+        paths = [(entry.name, entry.path) for entry in it
+                 if entry.name.startswith(prefix) and entry.name.endswith(suffix)]
+    # Report names embed ISO dates, so lexicographic order is chronological
+    paths.sort()
+    return tuple(path for _, path in paths)
+
+
+def list_reports(directory, prefix, suffix=".md"):
+    """
+    Returns report paths in `directory` matching prefix/suffix, oldest first.
+    `suffix` may be a tuple, e.g. (".md", ".md.gz") to include archived reports.
+    """
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+        return ()
+    return _scan_reports(directory, prefix, suffix, mtime_ns)
+
+
+@contextlib.contextmanager
+def atomic_open(path, encoding="utf-8"):
+    """
+    Opens `path + ".tmp"` for text writing and swaps it into place with
+    os.replace on success, so readers never see a half-written file.
+    On error the temp file is removed and `path` is left untouched.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding=encoding, buffering=WRITE_BUFFER_SIZE) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def open_report(path):
+    """Opens a report for text reading, transparently handling gzip archives."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def compress_old_reports(directory, prefix, max_age_days=30, today=None):
+    """
+    Gzips `<prefix><YYYY-MM-DD>.md` reports dated more than `max_age_days` ago
+    into `.md.gz` and removes the originals. Returns the number compressed.
+    """
+    cutoff = (today or datetime.date.today()) - datetime.timedelta(days=max_age_days)
+    compressed = 0
+    for path in list_reports(directory, prefix, ".md"):
+        date_part = os.path.basename(path)[len(prefix):-len(".md")]
+        try:
+            report_date = datetime.date.fromisoformat(date_part)
+        except ValueError:
+            continue
+        if report_date >= cutoff:
+            # Sorted by date, so everything after this is newer still
+            break
+        gz_path = path + ".gz"
+        tmp_path = gz_path + ".tmp"
+        try:
+            with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+                dst.write(src.read())
+            os.replace(tmp_path, gz_path)
+            os.remove(path)
+            compressed += 1
+        except OSError as e:
+            print(f"  [Warning] 無法壓縮舊報告 {os.path.basename(path)}: {e}")
+    return compressed
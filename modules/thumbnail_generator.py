@@ -5,9 +5,25 @@ Generates multiple style variants and title options for A/B testing.
 """
 import os
 import time
+import json
+import hashlib
 import datetime
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google import genai
 from google.genai import types
+from modules.file_utils import atomic_open
+
+# Styles are rendered concurrently; the semaphore caps in-flight image requests
+# so bursts stay under the API rate limit (429s are retried in generate_thumbnail)
+THUMBNAIL_MAX_WORKERS = 4
+IMAGE_CONCURRENT_LIMIT = 2
+_image_request_slots = threading.Semaphore(IMAGE_CONCURRENT_LIMIT)
+
+# Per-report manifest of generated titles/thumbnails, so reruns on an unchanged
+# report reuse them instead of calling Gemini again
+THUMBNAIL_CACHE_DIRNAME = ".thumb_cache"
 
 
 # === Visual Style Presets ===
@@ -61,16 +77,13 @@ STYLE_PRESETS = {
 }
 
 
-def generate_titles(client, report_content, num_titles=3):
-    """
-    Use Gemini to generate multiple YouTube title variations for A/B testing.
-    """
-    prompt = f"""
+# Prompt templates are built once at import; only title/date are filled per call
+_TITLES_PROMPT_TMPL = """
     你是一位專業的 YouTube 財經頻道標題撰寫專家。
     根據以下影片文案內容，生成 {num_titles} 個不同風格的 YouTube 標題。
 
     文案摘要：
-    {report_content[:1500]}
+    {report_excerpt}
 
     要求：
     1. 每個標題要有不同的「鉤子」策略（好奇心、緊迫感、數據驅動等）
@@ -82,6 +95,78 @@ def generate_titles(client, report_content, num_titles=3):
     請直接輸出標題，每行一個，不要編號，不要其他說明文字。
     """
 
+_IMAGE_PROMPT_PREFIX = """
+    Generate a YouTube thumbnail image in wide landscape 16:9 format.
+
+    Visual Style: """
+_IMAGE_PROMPT_SUFFIX = """
+
+    Text overlay requirements (MUST include these Chinese characters prominently):
+    - Main title: "{title}" in very large, bold font with strong outline and shadow
+    - Date: "{date_str}" in a banner or badge in the corner
+    
+    The text must be clearly readable, very large, and eye-catching.
+    This is a YouTube thumbnail so it needs to grab attention even at small sizes.
+    Professional quality, no human faces, focus on financial/stock market theme.
+    """
+
+# Per-style image prompt templates, built once; braces in the style text are
+# escaped so it is never treated as a placeholder
+_IMAGE_PROMPT_TMPLS = {
+    key: _IMAGE_PROMPT_PREFIX + preset["prompt"].replace("{", "{{").replace("}", "}}") + _IMAGE_PROMPT_SUFFIX
+    for key, preset in STYLE_PRESETS.items()
+}
+
+
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key):
+    """
+    One genai.Client per API key for the whole process; the SDK client is
+    thread-safe, so the concurrent thumbnail workers share it.
+    """
+    return genai.Client(api_key=api_key)
+
+
+def _report_digest(report_content, date_str):
+    """Cache key for a report; includes the date because it is drawn on the thumbnails."""
+    return hashlib.sha256(f"{date_str}\n{report_content}".encode("utf-8")).hexdigest()[:16]
+
+
+def _file_digest(path):
+    """sha256 of a file's bytes, or None if it can't be read."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(path, manifest):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path) as f:
+            json.dump(manifest, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"  [Warning] 無法寫入縮圖快取: {e}")
+
+
+def generate_titles(client, report_content, num_titles=3):
+    """
+    Use Gemini to generate multiple YouTube title variations for A/B testing.
+    """
+    prompt = _TITLES_PROMPT_TMPL.format_map({
+        "num_titles": num_titles,
+        "report_excerpt": report_content[:1500],
+    })
+
     response = client.models.generate_content(
         model="gemini-2.5-flash",
         contents=[prompt],
@@ -102,34 +187,23 @@ def generate_thumbnail(client, style_key, title, date_str, output_path, max_retr
         print(f"  [Error] 未知的風格: {style_key}")
         return False
 
-    image_prompt = f"""
-    Generate a YouTube thumbnail image in wide landscape 16:9 format.
-
-    Visual Style: {style['prompt']}
-
-    Text overlay requirements (MUST include these Chinese characters prominently):
-    - Main title: "{title}" in very large, bold font with strong outline and shadow
-    - Date: "{date_str}" in a banner or badge in the corner
-    
-    The text must be clearly readable, very large, and eye-catching.
-    This is a YouTube thumbnail so it needs to grab attention even at small sizes.
-    Professional quality, no human faces, focus on financial/stock market theme.
-    """
+    image_prompt = _IMAGE_PROMPT_TMPLS[style_key].format_map({"title": title, "date_str": date_str})
 
     wait_times = [30, 45, 60]
 
     for attempt in range(max_retries + 1):
         try:
-            response = client.models.generate_content(
-                model="gemini-2.5-flash-image",
-                contents=[image_prompt],
-                config=types.GenerateContentConfig(
-                    response_modalities=["Image"],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="16:9",
+            with _image_request_slots:
+                response = client.models.generate_content(
+                    model="gemini-2.5-flash-image",
+                    contents=[image_prompt],
+                    config=types.GenerateContentConfig(
+                        response_modalities=["Image"],
+                        image_config=types.ImageConfig(
+                            aspect_ratio="16:9",
+                        ),
                     ),
-                ),
-            )
+                )
 
             for part in response.parts:
                 if part.inline_data is not None:
@@ -168,7 +242,7 @@ def generate_ab_test_thumbnails(api_key, report_content, reports_dir,
     Returns:
         dict with 'titles' and 'thumbnails' lists
     """
-    client = genai.Client(api_key=api_key)
+    client = _get_client(api_key)
     date_str = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%m/%d")
     date_full = datetime.datetime.now().strftime("%Y-%m-%d")
 
@@ -177,46 +251,83 @@ def generate_ab_test_thumbnails(api_key, report_content, reports_dir,
 
     results = {"titles": [], "thumbnails": []}
 
+    manifest_path = os.path.join(reports_dir, THUMBNAIL_CACHE_DIRNAME, f"{_report_digest(report_content, date_str)}.json")
+    manifest = _load_manifest(manifest_path)
+
     # === Step 1: Generate title variations ===
     print("\n🎯 正在生成 YouTube 標題變體（A/B Test）...")
-    titles = generate_titles(client, report_content, num_titles)
+    if manifest.get("num_titles") == num_titles and manifest.get("titles"):
+        titles = manifest["titles"]
+        print("  ♻️  報告內容未變，沿用已生成的標題")
+    else:
+        titles = generate_titles(client, report_content, num_titles)
+        manifest = {"num_titles": num_titles, "titles": titles, "thumbnails": {}}
+        _save_manifest(manifest_path, manifest)
+    # style_key -> {"title", "sha256"} of a thumbnail already rendered for this report.
+    # The PNG names are per day, not per report, so another same-day report may have
+    # overwritten the file since; the content hash catches that.
+    cached_thumbnails = manifest.setdefault("thumbnails", {})
     results["titles"] = titles
     for i, title in enumerate(titles):
         print(f"  📝 標題 {i+1}: {title}")
 
     # === Step 2: Generate thumbnails with different styles ===
     print(f"\n🎨 正在生成 {len(styles)} 種風格的 YouTube 縮圖（16:9）...")
-    print(f"   （每張之間會間隔 15 秒以避免 API 速率限制）")
+    print(f"   （同時最多 {IMAGE_CONCURRENT_LIMIT} 個請求，遇到速率限制會自動重試）")
 
+    jobs = []
+    succeeded = {}
     for i, style_key in enumerate(styles):
-        style_name = STYLE_PRESETS[style_key]["name"]
         # Pair each style with a title (cycle if more styles than titles)
         title = titles[i % len(titles)]
-        short_title = title[:15] + "..." if len(title) > 15 else title
-
         filename = f"yt_thumbnail_{date_full}_{style_key}.png"
         output_path = os.path.join(reports_dir, filename)
-
-        # Wait between requests to avoid rate limiting
-        if i > 0:
-            print(f"\n     ⏳ 等待 15 秒避免速率限制...")
-            time.sleep(15)
-
-        print(f"\n  🖼️  風格 {i+1}/{len(styles)}: {style_name}")
-        print(f"     標題: {short_title}")
-        print(f"     生成中...")
-
-        success = generate_thumbnail(client, style_key, title, date_str, output_path)
-
-        if success:
-            print(f"     ✅ 已儲存: {filename}")
-            results["thumbnails"].append({
-                "style": style_name,
+        cached = cached_thumbnails.get(style_key)
+        if (isinstance(cached, dict) and cached.get("title") == title
+                and cached.get("sha256") == _file_digest(output_path)):
+            print(f"  ♻️  沿用已生成的縮圖: {filename}")
+            succeeded[i] = {
+                "style": STYLE_PRESETS[style_key]["name"],
                 "title": title,
                 "path": output_path,
-            })
-        else:
-            print(f"     ❌ 生成失敗")
+            }
+            continue
+        jobs.append((i, style_key, title, filename, output_path))
+
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(THUMBNAIL_MAX_WORKERS, len(jobs))) as ex:
+            futures = {}
+            for job in jobs:
+                _, style_key, title, _, output_path = job
+                futures[ex.submit(generate_thumbnail, client, style_key, title, date_str, output_path)] = job
+            print(f"     生成中...")
+
+            for future in as_completed(futures):
+                i, style_key, title, filename, output_path = futures[future]
+                style_name = STYLE_PRESETS[style_key]["name"]
+                short_title = title[:15] + "..." if len(title) > 15 else title
+                print(f"\n  🖼️  風格 {i+1}/{len(styles)}: {style_name}")
+                print(f"     標題: {short_title}")
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print(f"     [Error] 圖片生成失敗: {e}")
+                    success = False
+
+                if success:
+                    print(f"     ✅ 已儲存: {filename}")
+                    succeeded[i] = {
+                        "style": style_name,
+                        "title": title,
+                        "path": output_path,
+                    }
+                    cached_thumbnails[style_key] = {"title": title, "sha256": _file_digest(output_path)}
+                else:
+                    print(f"     ❌ 生成失敗")
+        _save_manifest(manifest_path, manifest)
+
+    # Keep the thumbnails in style order regardless of completion order
+    results["thumbnails"] = [succeeded[i] for i in sorted(succeeded)]
 
     return results
 
@@ -26,9 +26,13 @@ US_TOPICS = [
 REPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
 
 def main():
+    # One timestamp per run so the header, prompt and filenames always agree
+    now = datetime.datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+
     print(f"{'='*50}")
     print(f"  週末特輯：美股大逃殺與避險生存指南")
-    print(f"  日期: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    print(f"  日期: {now.strftime('%Y-%m-%d %H:%M')}")
     print(f"{'='*50}\n")
     
     if not TAVILY_API_KEY or not GEMINI_API_KEY:
@@ -36,13 +40,12 @@ def main():
         return
     
     fetcher = DataFetcher(TAVILY_API_KEY)
-    analyzer = MarketAnalyzer(GEMINI_API_KEY)
+    analyzer = MarketAnalyzer(GEMINI_API_KEY, semantic_cache=os.getenv("GEMINI_SEMANTIC_CACHE") == "1")
     
     # 1. Fetch US Market Data (Weekly Summary)
     market_data = {}
     print("\n📊 正在獲取美股與避險指標一週動態數據 (S&P500, Nasdaq, VIX, NVDA, TSM)...")
-    for symbol in US_SYMBOLS:
-        data = fetcher.get_weekly_stock_data(symbol)
+    for symbol, data in fetcher.get_many(US_SYMBOLS, weekly=True).items():
         if data:
             market_data[symbol] = data
             print(f"  ✅ {symbol}: 週收盤 ${data['week_close']} (本週漲跌 {data['week_pct_change']:+.2f}%)")
@@ -78,7 +81,6 @@ def main():
     )
     
     os.makedirs(REPORTS_DIR, exist_ok=True)
-    date_str = datetime.datetime.now().strftime('%Y-%m-%d')
     report_filename = f"weekend_special_report_{date_str}.md"
     report_filepath = os.path.join(REPORTS_DIR, report_filename)
     